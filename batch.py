@@ -0,0 +1,169 @@
+"""Пакетные прогоны ночи - seeded headless simulations of QuestNight on every core
+
+python batch.py --seeds 20 --enemy-types 0,1,2 --intervals 15,10 --health 30,50
+
+A seed shifts the start of the player strategy and the times of waves (--jitter).
+"""
+import argparse
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import main
+
+# стратегии игрока - шаги ScriptedInput, ходит вокруг ёлки или стоит рядом
+STRATEGIES = {
+    'idle': [(1, '')],
+    'attack': [(1, 'f')],
+    'guard': [(60, 'af'), (60, 'sf'), (60, 'df'), (60, 'wf')],
+    'patrol': [(120, 'a'), (30, 'af'), (120, 'd'), (30, 'df')],
+}
+
+
+def build_caches():
+    """Level and atlas caches are built once before the pool, workers only read them"""
+    main.init_display(headless=True)
+    main.load_compiled_level('map.txt')
+    main.atlas.load()
+
+
+def init_worker():
+    """Every process loads the game once, headless and without drawing"""
+    main.RENDER_MODE = 'none'
+    main.init_display(headless=True)
+    main.loader.submit('map.txt', main.load_compiled_level, 'map.txt')
+    main.atlas.load()
+    main.init_images()
+
+
+class Night:
+    """Только ночь из сценария Game - the tree health is noted every game second
+
+    Returns False when the night is over either way, result is 1 if the tree survived.
+    """
+
+    def __init__(self, enemy_type):
+        self.game = main.Game([(0, main.QuestNight, enemy_type, [])])
+        self.health = []
+        self.result = 0
+        self.time = 0
+
+    def __call__(self, time):
+        self.time = time
+        if time % 45 == 0:
+            self.health.append(main.tree.health)
+        if not self.game(time):
+            return False
+        if self.game.current_quest is None and time > 0:
+            self.result = 1
+            return False
+        return True
+
+
+def simulate(params):
+    """One night with params, returns them with the outcome"""
+    main.rng.seed(params['seed'])
+    steps = STRATEGIES[params['strategy']]
+    main.controls = main.ScriptedInput(steps)
+    # seed сдвигает начало стратегии, остальное в игре от seed почти не зависит
+    for _ in range(main.rng.randrange(sum(ticks for ticks, _ in steps))):
+        main.controls.pressed()
+    main.QuestNight.spawn_interval = params['interval'] * 45
+    main.QuestNight.wave_jitter = round(params['jitter'] * 45)
+    main.QuestNight.tree_health = params['tree_health']
+    main.load_world(main.loader.result('map.txt'))
+    # игрок сразу у ёлки, ночь начинается на первом тике
+    main.player.rect.topleft = main.player.last_pos = (main.tree.rect.x, main.tree.rect.y + 90)
+    night = Night(params['enemy_type'])
+    main.run(main.QuestNight.duration / 45 + 1, night)
+    return dict(params, survived=night.result == 1, ticks=night.time, health=night.health,
+                enemies_left=main.enemy_swarm.count)
+
+
+def summary(runs):
+    """Survival rate, mean survived seconds and mean health curve of runs of one setup"""
+    length = max(len(run['health']) for run in runs)
+    curves = np.array([run['health'] + [0] * (length - len(run['health'])) for run in runs])
+    return {'runs': len(runs),
+            'survival_rate': round(sum(run['survived'] for run in runs) / len(runs), 3),
+            'mean_seconds': round(float(np.mean([len(run['health']) for run in runs])), 1),
+            'health_curve': np.round(curves.mean(axis=0), 2).tolist()}
+
+
+def sweep(setups, seeds, workers=None, on_result=None):
+    """Run every setup with every seed on a process pool, {setup: summary}
+
+    on_result gets every run as soon as it is finished. A run that raised comes to it
+    with 'error' and is left out of the summaries.
+    """
+    runs = {}
+    build_caches()
+    with ProcessPoolExecutor(workers, initializer=init_worker) as pool:
+        futures = {}
+        for setup in setups:
+            for seed in range(seeds):
+                params = dict(setup, seed=seed)
+                futures[pool.submit(simulate, params)] = params
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                # одна сломанная комбинация не останавливает остальные прогоны
+                result = dict(futures[future], error=repr(error))
+            if on_result is not None:
+                on_result(result)
+            if 'error' in result:
+                continue
+            key = tuple((name, result[name]) for name in setups[0])
+            runs.setdefault(key, []).append(result)
+    return {key: summary(results) for key, results in runs.items()}
+
+
+def numbers(text, kind=int):
+    return [kind(value) for value in text.split(',')]
+
+
+def enemy_types(text):
+    """Типы врагов ночи - the next type must exist too, it comes in the second half"""
+    types = numbers(text)
+    last = len(main.ENEMY_SHEETS) - 2
+    for enemy_type in types:
+        if not 0 <= enemy_type <= last:
+            raise argparse.ArgumentTypeError(f'enemy types are 0..{last}, not {enemy_type}')
+    return types
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Пакетные прогоны ночи')
+    parser.add_argument('--seeds', type=int, default=10, help='runs of every setup')
+    parser.add_argument('--enemy-types', type=enemy_types, default=[0], help='like 0,1,2')
+    parser.add_argument('--intervals', type=numbers, default=[15],
+                        help='seconds between waves, like 15,10')
+    parser.add_argument('--health', type=numbers, default=[30], help='tree health, like 30,50')
+    parser.add_argument('--jitter', type=float, default=3,
+                        help='seconds a wave may come earlier or later, differs by seed')
+    parser.add_argument('--strategies', default='idle,guard', help=','.join(STRATEGIES))
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes')
+    parser.add_argument('--output', default='batch_runs.jsonl', help='every run as a JSON line')
+    args = parser.parse_args()
+
+    names = ('enemy_type', 'interval', 'tree_health', 'strategy')
+    setups = [dict(zip(names, values), jitter=args.jitter) for values in itertools.product(
+        args.enemy_types, args.intervals, args.health, args.strategies.split(','))]
+    with open(args.output, 'w') as output:
+        def on_result(result):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            setup = ' '.join(f'{name}={result[name]}' for name in names + ('seed',))
+            if 'error' in result:
+                print(setup, 'failed:', result['error'])
+            else:
+                print(setup, 'survived' if result['survived'] else f"lost at {result['ticks'] // 45}s")
+
+        summaries = sweep(setups, args.seeds, args.workers, on_result)
+    for key, result in sorted(summaries.items()):
+        print(' '.join(f'{name}={value}' for name, value in key),
+              f"survival {result['survival_rate']:.0%}, {result['mean_seconds']}s on average")
@@ -0,0 +1,189 @@
+"""Замеры скорости игры без окна - load, generate, update and draw stages
+
+python benchmark.py                      run, write results and compare with the baseline
+python benchmark.py --save-baseline      run and store results as the new baseline
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+from time import perf_counter
+
+import numpy as np
+import pygame
+
+import main
+
+BASELINE = 'benchmarks/baseline.json'
+ENEMY_COUNTS = (0, 50, 200, 800)
+PARTICLE_COUNTS = (0, 250, 1000)
+MAP_SCALES = (1, 2, 4)
+
+
+def measure(func, repeat):
+    """min, median and max ms of repeat calls"""
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return summary(times)
+
+
+def summary(times):
+    times = np.array(times) * 1000
+    return {'min': round(float(times.min()), 4), 'median': round(float(np.median(times)), 4),
+            'max': round(float(times.max()), 4)}
+
+
+def scaled_map(scale):
+    """map.txt repeated scale x scale times, player and grandmother only in the first copy"""
+    level = main.load_level('map.txt')
+    copy = [line.replace('#', 'K') for line in level]
+    copy = [line.replace('@', line[line.index('@') + 1]) if '@' in line else line
+            for line in copy]
+    rows = []
+    for copy_y in range(scale):
+        for y in range(len(level)):
+            rows.append(''.join(level[y] if copy_y == 0 and copy_x == 0 else copy[y]
+                                for copy_x in range(scale)))
+    return rows
+
+
+def run_frames(frames, enemies=0, particles=0):
+    """min, median and max ms of one run() frame with enemies and particles around the player
+
+    Particles live only a few updates, dead ones are emitted again every tick,
+    so every frame has the same number of them.
+    """
+    rng = main.rng
+    view = main.player.rect.inflate(main.WIDTH, main.HEIGHT)
+    main.enemy_swarm.clear()
+    main.particle_emitter.clear()
+    for _ in range(enemies):
+        main.enemy_swarm.spawn(rng.randrange(4), rng.randrange(view.left, view.right),
+                               rng.randrange(view.top, view.bottom), rng.randrange(4))
+
+    def emit(time=None):
+        while main.particle_emitter.count < particles:
+            main.particle_emitter.burst((rng.randrange(view.left, view.right),
+                                         rng.randrange(view.top, view.bottom)),
+                                        min(20, particles - main.particle_emitter.count),
+                                        image=1)
+        return True
+
+    emit()
+    main.tree.health = 10 ** 9
+    main.frame_stats.times.clear()
+    main.run(frames / 45, emit)
+    return summary(main.frame_stats.times)
+
+
+def place_quest_items():
+    quest = main.QuestCookies(15, 0)
+    quest.begin(main.Game([]), 0)
+    quest.start(0)
+    for item in list(quest.group):
+        item.kill()
+
+
+def collect(repeat, frames):
+    results = {}
+
+    results['load_level'] = measure(lambda: main.load_level('map.txt'), repeat)
+    text_map = main.load_level('map.txt')
+    results['compile_level'] = measure(lambda: main.compile_level(text_map), repeat)
+    results['load_compiled_level'] = measure(
+        lambda: main.load_compiled_level('map.txt'), repeat)
+
+    results['assets/bake_images'] = measure(main.bake_images, max(1, repeat // 4))
+    results['assets/atlas'] = measure(main.atlas.load, repeat)
+    results['assets/music_decode'] = measure(lambda: main.audio.decode('music2.ogg'),
+                                             max(1, repeat // 4))
+    results['assets/init_images'] = measure(main.init_images, repeat)
+
+    level = main.load_compiled_level('map.txt')
+    results['generate_level'] = measure(lambda: main.load_world(level), repeat)
+    results['quest_placement'] = measure(place_quest_items, repeat * 10)
+
+    for enemies in ENEMY_COUNTS:
+        results[f'frame/enemies={enemies}'] = run_frames(frames, enemies=enemies)
+    for particles in PARTICLE_COUNTS:
+        results[f'frame/particles={particles}'] = run_frames(frames, particles=particles)
+
+    for scale in MAP_SCALES:
+        level = main.compile_level(scaled_map(scale))
+        results[f'scaled/{scale}x/generate_level'] = measure(lambda: main.load_world(level),
+                                                             max(1, repeat // scale))
+        results[f'scaled/{scale}x/frame'] = run_frames(frames, enemies=200, particles=250)
+    return results
+
+
+def scaling(results):
+    """Median time of every case over the smallest case of its series - does not depend
+    on the machine"""
+    series = {f'frame/enemies={count}': 'frame/enemies=0' for count in ENEMY_COUNTS}
+    series.update({f'frame/particles={count}': 'frame/particles=0' for count in PARTICLE_COUNTS})
+    for scale in MAP_SCALES:
+        for stage in ('generate_level', 'frame'):
+            series[f'scaled/{scale}x/{stage}'] = f'scaled/{MAP_SCALES[0]}x/{stage}'
+    return {name: round(results[name]['median'] / results[base]['median'], 3)
+            for name, base in series.items() if name != base}
+
+
+def compare(current, stored, tolerance):
+    """(name, old, new, ratio) of results and scaling ratios grown by more than tolerance
+
+    Results are compared by the median call, the fastest one may miss the work entirely.
+    """
+    pairs = [(name, stored['results'][name]['median'], result['median'])
+             for name, result in current['results'].items() if name in stored['results']]
+    pairs += [(name, stored['scaling'][name], ratio)
+              for name, ratio in current['scaling'].items() if name in stored['scaling']]
+    return [(name, old, new, new / old) for name, old, new in pairs
+            if old > 0 and new / old > 1 + tolerance]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Замеры скорости игры')
+    parser.add_argument('--output', default='bench_results.json', help='results file')
+    parser.add_argument('--baseline', default=BASELINE, help='stored results to compare with')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write results to the baseline instead of comparing')
+    parser.add_argument('--repeat', type=int, default=20, help='calls of every stage')
+    parser.add_argument('--frames', type=int, default=90, help='run() frames of every case')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed slowdown against the baseline, 0.5 - 50%%')
+    args = parser.parse_args()
+
+    main.init_display(headless=True)
+    main.rng.seed(0)
+    main.atlas.load()
+    main.init_images()
+    main.audio.init()
+
+    report = {'python': platform.python_version(), 'pygame': pygame.version.ver,
+              'machine': platform.machine(), 'repeat': args.repeat, 'frames': args.frames,
+              'results': collect(args.repeat, args.frames)}
+    report['scaling'] = scaling(report['results'])
+    for name, result in report['results'].items():
+        print(f"{name:36} {result['min']:10.3f} {result['median']:10.3f} ms")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=1)
+        print('baseline saved to', args.baseline)
+        sys.exit()
+
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=1)
+    if not os.path.exists(args.baseline):
+        print('no baseline at', args.baseline)
+        sys.exit()
+    with open(args.baseline) as baseline_file:
+        slower = compare(report, json.load(baseline_file), args.tolerance)
+    for name, old, new, ratio in slower:
+        print(f'slower: {name} {old:.3f} -> {new:.3f} (x{ratio:.2f})')
+    sys.exit(1 if slower else 0)
@@ -1,16 +1,43 @@
+import argparse
+import hashlib
+import heapq
+import json
+import mmap
+import random
+import re
+import struct
 import sys
-from random import randint, choice
-
+import tempfile
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import numpy as np
 import pygame
 import os
 
 WIDTH = 500
 HEIGHT = 500
 SIZE = (WIDTH, HEIGHT)
-screen = pygame.display.set_mode(SIZE)
+# окно создаёт init_display, в headless режиме вместо него dummy-драйвер SDL
+screen = None
+HEADLESS = False
 
 FPS = 60
+# шагов симуляции в секунду реального времени, отрисовка может пропускать кадры;
+# скорости и сроки игры заданы в шагах (45 шагов - секунда на игровых часах),
+# поэтому частота постоянная
+SIM_RATE = 60
+# больше этого за кадр не догоняем (окно перетаскивали, отладчик и т.п.)
+MAX_FRAME_TIME = 250
+# 'full' - redraw and flip whole screen, 'dirty' - cull sprites and update only changed rects,
+# 'none' - only simulation, for batch runs without a window (default for --headless)
+RENDER_MODE = os.environ.get('RENDER_MODE', 'full')
 clock = pygame.time.Clock()
+# случайность только через rng игры, тогда запись с тем же seed повторяется точно
+rng = random.Random()
 pygame.font.init()
 
 
@@ -19,6 +46,148 @@ def terminate():
     sys.exit()
 
 
+def init_display(headless=False):
+    """Окно игры - or SDL dummy drivers with no picture and no sound"""
+    global screen, HEADLESS
+    HEADLESS = headless
+    if headless:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    screen = pygame.display.set_mode(SIZE)
+
+
+class PressedKeys(frozenset):
+    """Key codes read like pygame.key.get_pressed()"""
+
+    def __getitem__(self, key):
+        return key in self
+
+
+class KeyboardInput:
+    """Ввод с клавиатуры"""
+    live = True
+    finished = False
+
+    def pressed(self):
+        return pygame.key.get_pressed()
+
+    def choose(self, button):
+        """Answer of a dialog - the mouse button it was closed with"""
+        return button
+
+
+class ScriptedInput:
+    """Ввод по сценарию - list of (ticks, keys) steps, pressed() is called once per tick"""
+
+    live = False
+
+    def __init__(self, steps, repeat=True, choices=()):
+        self.steps = [(ticks, PressedKeys(ord(key) for key in keys))
+                      for ticks, keys in steps if ticks > 0]
+        self.choices = list(choices)
+        self.repeat = repeat
+        self.index = -1
+        self.left = 0
+        self.finished = False
+
+    @classmethod
+    def load(cls, filename, repeat=True):
+        """Lines 'ticks keys' like '45 wf', keys as on keyboard, empty - nothing pressed"""
+        steps = []
+        with open(filename, encoding='utf8') as script:
+            for line in script:
+                line = line.split('#')[0].split()
+                if line:
+                    steps.append((int(line[0]), ''.join(line[1:])))
+        return cls(steps, repeat)
+
+    def pressed(self):
+        while self.left <= 0:
+            if self.index + 1 < len(self.steps):
+                self.index += 1
+            elif self.repeat and self.steps:
+                self.index = 0
+            else:
+                self.finished = True
+                return PressedKeys()
+            self.left = self.steps[self.index][0]
+        self.left -= 1
+        return self.steps[self.index][1]
+
+    def choose(self, button):
+        """Recorded answers of dialogs in turn, then the default one"""
+        if self.choices:
+            return self.choices.pop(0) or None
+        return button
+
+
+class InputRecorder:
+    """Запись ввода - run-length steps of pressed game keys and dialog answers, with the seed
+
+    The simulation reads nothing but these keys and the answers, closing the window
+    ends the recording, so they and the seed are enough to replay a session.
+    """
+    keys = 'wasdf'
+    magic = b'NYIR'
+    version = 2
+    header = struct.Struct('<4sHQII')
+    step = struct.Struct('<HB')
+
+    def __init__(self, source, seed):
+        self.source = source
+        self.seed = seed
+        self.steps = []
+        self.choices = []
+
+    @property
+    def live(self):
+        return self.source.live
+
+    @property
+    def finished(self):
+        return self.source.finished
+
+    def pressed(self):
+        keys = self.source.pressed()
+        mask = sum(1 << i for i, key in enumerate(self.keys) if keys[ord(key)])
+        if self.steps and self.steps[-1][1] == mask and self.steps[-1][0] < 0xFFFF:
+            self.steps[-1][0] += 1
+        else:
+            self.steps.append([1, mask])
+        return keys
+
+    def choose(self, button):
+        button = self.source.choose(button)
+        self.choices.append(button or 0)
+        return button
+
+    def to_bytes(self):
+        return self.header.pack(self.magic, self.version, self.seed, len(self.steps),
+                                len(self.choices)) + \
+            b''.join(self.step.pack(ticks, mask) for ticks, mask in self.steps) + \
+            bytes(self.choices)
+
+    def save(self, filename):
+        with open(filename, 'wb') as record:
+            record.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, filename):
+        """(seed, ScriptedInput that plays the recording once)"""
+        with open(filename, 'rb') as record:
+            data = record.read()
+        magic, version, seed, count, choices = cls.header.unpack_from(data)
+        if magic != cls.magic or version != cls.version:
+            raise ValueError(f'{filename} is not an input recording of version {cls.version}')
+        end = cls.header.size + count * cls.step.size
+        steps = [(ticks, ''.join(key for i, key in enumerate(cls.keys) if mask >> i & 1))
+                 for ticks, mask in cls.step.iter_unpack(data[cls.header.size:end])]
+        return seed, ScriptedInput(steps, repeat=False, choices=data[end:end + choices])
+
+
+controls = KeyboardInput()
+
+
 def load_level(filename):
     filename = "data/" + filename
     with open(filename, 'r') as mapFile:
@@ -31,6 +200,138 @@ def load_level(filename):
                     level_map))
 
 
+# флаги клеток скомпилированного уровня
+WALL = 1
+BLOCKED = 2
+NO_TILE = 255
+PLAYER, TREE, GRANDMOTHER, ITEM = range(4)
+SPAWNER_ROTATES = {'*': 0, '-': 1, '+': 2, '/': 3}
+# листы врагов по типам, ночь с типом N во второй половине выпускает тип N + 1
+ENEMY_SHEETS = ('Enemy 06-1.png', 'Enemy 04-1.png', 'Enemy 05-1.png', 'Enemy 03-1.png')
+
+
+class Level:
+    """Скомпилированный уровень - tile ids, collision flags, spawners and entities"""
+
+    magic = b'NYML'
+    # меняется вместе с compile_level, старые .lvl тогда не подходят
+    version = 1
+    header = struct.Struct('<4sHHHH')
+    spawner = struct.Struct('<HHB')
+    entity = struct.Struct('<BBhhh')
+
+    def __init__(self, width, height, tiles, flags, spawners, entities):
+        self.width = width
+        self.height = height
+        self.tiles = tiles
+        self.flags = flags
+        self.spawners = spawners
+        self.entities = entities
+
+    def to_bytes(self):
+        return b''.join([
+            self.header.pack(self.magic, self.width, self.height, len(self.spawners),
+                             len(self.entities)),
+            bytes(self.tiles), bytes(self.flags),
+            *(self.spawner.pack(*spawner) for spawner in self.spawners),
+            *(self.entity.pack(*entity) for entity in self.entities)])
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Level over buffer (mmap), tiles and flags are not copied"""
+        buffer = memoryview(buffer)
+        magic, width, height, n_spawners, n_entities = cls.header.unpack_from(buffer)
+        if magic != cls.magic:
+            raise ValueError('not a compiled level')
+        offset = cls.header.size
+        cells = width * height
+        tiles = buffer[offset:offset + cells]
+        flags = buffer[offset + cells:offset + 2 * cells]
+        offset += 2 * cells
+        spawners = list(cls.spawner.iter_unpack(
+            buffer[offset:offset + n_spawners * cls.spawner.size]))
+        offset += n_spawners * cls.spawner.size
+        entities = list(cls.entity.iter_unpack(
+            buffer[offset:offset + n_entities * cls.entity.size]))
+        return cls(width, height, tiles, flags, spawners, entities)
+
+
+def compile_level(level):
+    """Text map from load_level -> Level"""
+    height = len(level)
+    width = max(map(len, level))
+    tiles = bytearray([NO_TILE]) * (width * height)
+    flags = bytearray(width * height)
+    spawners = []
+    entities = []
+    for y in range(height):
+        for x in range(len(level[y])):
+            char = level[y][x]
+            i = y * width + x
+            if char.isdigit():
+                if int(char) == 5:
+                    entities.append((ITEM, 4, x - 1, y, 48))
+                else:
+                    entities.append((ITEM, int(char) - 1, x, y, 0))
+                tiles[i] = 6 * 9 + 4
+                flags[i] = BLOCKED
+            elif char == '@':
+                entities.append((PLAYER, 0, x, y, 0))
+                tiles[i] = ord(level[y][x + 1]) - ord("A")
+            elif char == '=':
+                entities.append((TREE, 0, x - 1, y - 1, 0))
+                tiles[i] = 16
+                flags[i] = BLOCKED
+            elif char in SPAWNER_ROTATES:
+                spawners.append((x, y, SPAWNER_ROTATES[char]))
+                tiles[i] = 40
+            elif char == "#":
+                entities.append((GRANDMOTHER, 0, x, y, 0))
+                tiles[i] = ord(level[y - 1][x]) - ord("A")
+                flags[i] = BLOCKED
+            elif char in ('K', "", "}"):
+                tiles[i] = ord(char) - ord('A')
+                flags[i] = WALL
+            else:
+                tiles[i] = ord(char) - ord('A')
+    return Level(width, height, tiles, flags, spawners, entities)
+
+
+def load_compiled_level(filename, cache_dir='data/cache'):
+    """Level from cache keyed by hash of map file, compile it if there is no cache
+
+    Several processes may build the cache at once, each writes its own temp file and
+    renames it into place.
+    """
+    with open("data/" + filename, 'rb') as mapFile:
+        key = hashlib.sha1(Level.magic + str(Level.version).encode() +
+                           mapFile.read()).hexdigest()[:16]
+    name = os.path.splitext(filename)[0]
+    path = os.path.join(cache_dir, f'{name}-{key}.lvl')
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # только кэши этой карты - у map-2 префикс тоже map-
+        stale = re.compile(re.escape(name) + '-[0-9a-f]{16}\\.lvl')
+        for old in os.listdir(cache_dir):
+            if stale.fullmatch(old) and old != os.path.basename(path):
+                try:
+                    os.remove(os.path.join(cache_dir, old))
+                except FileNotFoundError:
+                    # его уже убрал другой процесс
+                    pass
+        handle, temp_path = tempfile.mkstemp(suffix='.lvl.tmp', prefix=name + '-',
+                                             dir=cache_dir)
+        try:
+            with os.fdopen(handle, 'wb') as cacheFile:
+                cacheFile.write(compile_level(load_level(filename)).to_bytes())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    with open(path, 'rb') as cacheFile:
+        return Level.from_buffer(mmap.mmap(cacheFile.fileno(), 0, access=mmap.ACCESS_READ))
+
+
 def load_image(name, colorkey=None):
     fullname = os.path.join('data', name)
     image = pygame.image.load(fullname)
@@ -62,39 +363,667 @@ def cut_sheet(sheet, rows, pix_x1=0, pix_y1=0, pix_x2=-1, pix_y2=-1):
     return rect, frames
 
 
-def text_screen(text, one_flip=False):
-    """Отображение текстовой информации"""
-    font = pygame.font.Font(None, 30)
-    text_coord = 50
-    for line in text:
-        string_rendered = font.render(line, 1, pygame.Color('white'))
-        intro_rect = string_rendered.get_rect()
-        blck_surf = pygame.Surface(intro_rect.size)
-        blck_surf.fill((0, 0, 0))
-        text_coord += 10
-        screen.blit(blck_surf, (10, text_coord))
-        intro_rect.top = text_coord
-        intro_rect.x = 10
-        text_coord += intro_rect.height
-        screen.blit(string_rendered, intro_rect)
-
-    while True:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                terminate()
-            elif event.type == pygame.MOUSEBUTTONDOWN:
+def bake_images():
+    """Все картинки игры, уже увеличенные и нарезанные - source of the atlas"""
+    tiles = cut_sheet(pygame.transform.scale(load_image('tiles3.png'), (64 * 9, 64 * 6)),
+                      [9] * 6)[1][0]
+    tiles2 = list(
+        map(lambda images_list: list(
+            map(lambda image: pygame.transform.scale(image, (64, 64)), images_list)),
+            cut_sheet(load_image('Tileset.png'),
+                      [3] * 3, pix_x2=16 * 3, pix_y2=16 * 3)[1][0]))
+    # transform all images to 64 x 64
+
+    items = cut_sheet(load_image('Tileset.png'), [3, 3], 0, 16 * 7, 16 * 3, 16 * 9)[1][0]
+    items = items[0] + items[1]
+    items.append(load_image('spider_web.png'))
+    items = list(map(lambda image: pygame.transform.scale(image, (48, 48)), items))
+    items.append(load_image('mandarin.png'))
+
+    fire = [load_image("star.png")]
+    for scale in (5, 10, 20):
+        fire.append(pygame.transform.scale(fire[0], (scale, scale)))
+
+    return {
+        'tiles': sum(tiles, []) + sum(tiles2, []),
+        'items': items,
+        'enemies': [pygame.transform.scale(load_image(name), (48 * 3, 48 * 4))
+                    for name in ENEMY_SHEETS],
+        'fire': fire,
+        'player': [pygame.transform.scale(load_image('player.png'), (64 * 13, 64 * 16))],
+        'christmas_tree': [load_image('christmas_tree_w_snow.png')],
+        'grandmother': [pygame.transform.scale(load_image('grandmother.png').subsurface(
+            pygame.Rect((0, 0), (32, 32))), (48, 48))],
+    }
+
+
+class Atlas:
+    """Атлас - baked images packed in one raw BGRA sheet with an index, rebuilt when sources change
+
+    The sheet is stored in the pixel layout of convert_alpha() surfaces, so loading it is
+    one copy-on-write mmap with no decoding or converting. read() only touches files and may
+    run on a loader thread, surfaces are made by load() and bake() on the main thread.
+    """
+
+    version = 1
+    sources = ['tiles3.png', 'Tileset.png', 'spider_web.png', 'mandarin.png', 'star.png',
+               'Enemy 03-1.png', 'Enemy 04-1.png', 'Enemy 05-1.png', 'Enemy 06-1.png',
+               'player.png', 'christmas_tree_w_snow.png', 'grandmother.png']
+
+    def __init__(self, path='data/cache/atlas', width=1024):
+        self.path = path
+        self.width = width
+        self.frames = {}
+        self.pixels = None
+
+    def __getitem__(self, name):
+        return self.frames[name]
+
+    def stamp(self):
+        stamp = {'version': self.version}
+        for name in self.sources:
+            stat = os.stat(os.path.join('data', name))
+            stamp[name] = [stat.st_mtime_ns, stat.st_size]
+        return stamp
+
+    def read(self):
+        """(index, mapped pixels) of the cache, None if it is missing or stale"""
+        try:
+            with open(self.path + '.json') as indexFile:
+                index = json.load(indexFile)
+            if index['stamp'] != self.stamp():
+                return None
+            with open(self.path + '.raw', 'rb') as rawFile:
+                return index, mmap.mmap(rawFile.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError):
+            return None
+
+    def load(self, cached=None):
+        """Frames from cached - a result of read(), the cache is baked first if it is stale"""
+        if cached is None:
+            cached = self.read()
+        if cached is None:
+            self.bake()
+            cached = self.read()
+        index, self.pixels = cached
+        sheet = pygame.image.frombuffer(self.pixels, index['size'], 'BGRA')
+        self.frames = {name: [sheet.subsurface(rect) for rect in rects]
+                       for name, rects in index['frames'].items()}
+
+    def bake(self):
+        """Pack images in rows (shelves) by height and save the sheet and index"""
+        images = bake_images()
+        order = sorted(((image.get_height(), name, i) for name, frames in images.items()
+                        for i, image in enumerate(frames)), reverse=True)
+        width = max(self.width, max(image.get_width() for frames in images.values()
+                                    for image in frames))
+        rects = {name: [None] * len(frames) for name, frames in images.items()}
+        x = y = shelf = 0
+        for height, name, i in order:
+            image_width = images[name][i].get_width()
+            if x + image_width > width:
+                x, y, shelf = 0, y + shelf, 0
+            rects[name][i] = [x, y, image_width, height]
+            x += image_width
+            shelf = max(shelf, height)
+        sheet = pygame.Surface((width, y + shelf), pygame.SRCALPHA)
+        for name, frames in images.items():
+            for image, rect in zip(frames, rects[name]):
+                # сложение с прозрачным листом копирует пиксели вместе с альфой
+                sheet.blit(image, rect, special_flags=pygame.BLEND_RGBA_ADD)
+        index = {'stamp': self.stamp(), 'size': sheet.get_size(), 'frames': rects}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # индекс последним - кто прочитал новый индекс, найдёт и новый лист
+        self.replace('.raw', pygame.image.tobytes(sheet, 'BGRA'))
+        self.replace('.json', json.dumps(index).encode())
+        return index
+
+    def replace(self, suffix, data):
+        """Write a temp file next to the cache and rename it, other processes may mmap the old one"""
+        handle, temp_path = tempfile.mkstemp(suffix=suffix + '.tmp',
+                                             prefix=os.path.basename(self.path) + '-',
+                                             dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(handle, 'wb') as cacheFile:
+                cacheFile.write(data)
+            os.replace(temp_path, self.path + suffix)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+
+atlas = Atlas()
+
+
+class AssetLoader:
+    """Загрузка ресурсов в фоне - jobs run on a thread pool and are kept as futures
+
+    Jobs only read files and decode data, SDL surfaces are made on the main thread.
+    Time of every job goes to the profiler records.
+    """
+
+    def __init__(self, workers=2):
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='assets')
+        self.futures = {}
+
+    def submit(self, name, func, *args):
+        self.futures[name] = self.pool.submit(self.timed, name, func, *args)
+        return self.futures[name]
+
+    @staticmethod
+    def timed(name, func, *args):
+        start = perf_counter()
+        result = func(*args)
+        profiler.loaded(name, perf_counter() - start)
+        return result
+
+    def ready(self, *names):
+        return all(self.futures[name].done() for name in names)
+
+    def progress(self):
+        """Part of finished jobs, from 0 to 1"""
+        if not self.futures:
+            return 1
+        return sum(future.done() for future in self.futures.values()) / len(self.futures)
+
+    def result(self, name):
+        return self.futures[name].result()
+
+
+loader = AssetLoader()
+
+
+class AudioManager:
+    """Музыка и звуки - decoded in the background into Sounds, tracks are crossfaded
+
+    Tracks loop on two reserved channels, switching fades one out and the other in, the mixing
+    itself runs on the SDL audio thread. Without a sound device (or headless) nothing is
+    decoded or played, only the name of the current track is kept for snapshots.
+    """
+    fade_ms = 1500
+
+    def __init__(self):
+        self.enabled = False
+        self.track = None
+        self.channels = []
+        self.current = 0
+
+    def init(self, enabled=True):
+        self.enabled = False
+        if enabled:
+            try:
+                pygame.mixer.init()
+            except pygame.error:
                 return
+            pygame.mixer.set_reserved(2)
+            self.channels = [pygame.mixer.Channel(0), pygame.mixer.Channel(1)]
+            self.enabled = True
+
+    def preload(self, *names):
+        for name in names:
+            loader.submit(name, self.decode, name)
+
+    def decode(self, name):
+        if not self.enabled:
+            return None
+        return pygame.mixer.Sound(os.path.join('data', name))
+
+    def play(self, name, fade_ms=None):
+        """Switch to the preloaded track name, it keeps playing if it is already on"""
+        if name == self.track:
+            return
+        self.track = name
+        if not self.enabled:
+            return
+        fade_ms = self.fade_ms if fade_ms is None else fade_ms
+        # обычно уже декодировано, иначе ждём фоновую загрузку
+        with profiler.scope('audio_wait'):
+            sound = loader.result(name)
+        self.channels[self.current].fadeout(fade_ms)
+        self.current = 1 - self.current
+        self.channels[self.current].play(sound, loops=-1, fade_ms=fade_ms)
+
+    def stop(self):
+        self.track = None
+        for channel in self.channels:
+            channel.stop()
+
+
+audio = AudioManager()
+
+
+class TextCache:
+    """Шрифты и кэш отрисованного текста - bounded LRU of rendered strings and glyphs"""
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.fonts = {}
+        self.rendered = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def font(self, size):
+        if size not in self.fonts:
+            self.fonts[size] = pygame.font.Font(None, size)
+        return self.fonts[size]
+
+    def render(self, text, size=30, color='white'):
+        key = (text, size, color)
+        image = self.rendered.get(key)
+        if image is not None:
+            self.hits += 1
+            self.rendered.move_to_end(key)
+            return image
+        self.misses += 1
+        image = self.font(size).render(text, 1, pygame.Color(color))
+        self.rendered[key] = image
+        if len(self.rendered) > self.max_size:
+            self.rendered.popitem(last=False)
+        return image
+
+    def blit_glyphs(self, surface, text, pos, size=30, color='white'):
+        """Draw text char by char, so only a few glyphs are ever rendered"""
+        x, y = pos
+        for char in text:
+            glyph = self.render(char, size, color)
+            surface.blit(glyph, (x, y))
+            x += glyph.get_width()
+
+
+text_cache = TextCache()
+
+
+class Dialog:
+    """Текстовый экран - drawn once over the current frame, then waits for events
+
+    Text that does not fit the screen is split into pages. A mouse button, Enter or Space
+    turns the page, the button closing the last page is returned (keys count as the left one).
+    Between events the process sleeps in pygame.event.wait, the picture is redrawn only
+    when the window is exposed or resized.
+    """
+    top = 50
+    spacing = 10
+    # ждём событие не дольше, заодно так часто обновляется экран загрузки
+    timeout = 100
+    keys = (pygame.K_RETURN, pygame.K_KP_ENTER, pygame.K_SPACE)
+    redraw_events = (pygame.VIDEOEXPOSE, pygame.VIDEORESIZE,
+                     pygame.WINDOWEXPOSED, pygame.WINDOWRESIZED)
+
+    def __init__(self, text):
+        # кадр под диалогом, его копирует wait() - только ему нужно листать страницы
+        self.background = None
+        self.pages = self.paginate([text_cache.render(line) for line in text])
+        self.page = 0
+
+    @classmethod
+    def paginate(cls, images):
+        """Lists of line images, every one fits the screen with the page number below it"""
+        bottom = HEIGHT - text_cache.font(30).get_linesize() - cls.spacing
+        pages = [[]]
+        text_coord = cls.top
+        for image in images:
+            text_coord += cls.spacing + image.get_height()
+            if text_coord > bottom and pages[-1]:
+                pages.append([])
+                text_coord = cls.top + cls.spacing + image.get_height()
+            pages[-1].append(image)
+        return pages
+
+    def draw(self):
+        dirty_tracker.invalidate()
+        if self.background is not None:
+            screen.blit(self.background, (0, 0))
+        lines = self.pages[self.page]
+        if len(self.pages) > 1:
+            lines = lines + [text_cache.render(f'{self.page + 1}/{len(self.pages)}')]
+        text_coord = self.top
+        for string_rendered in lines:
+            intro_rect = string_rendered.get_rect()
+            text_coord += self.spacing
+            intro_rect.top = text_coord
+            intro_rect.x = 10
+            screen.fill((0, 0, 0), intro_rect)
+            text_coord += intro_rect.height
+            screen.blit(string_rendered, intro_rect)
         pygame.display.flip()
-        clock.tick(FPS)
-        if one_flip:
-            break
+
+    def poll(self, timeout=None):
+        """Handle one event or wait timeout ms, the closing button or None"""
+        event = pygame.event.wait(self.timeout if timeout is None else timeout)
+        button = None
+        if event.type == pygame.QUIT:
+            terminate()
+        elif event.type == pygame.MOUSEBUTTONDOWN:
+            button = event.button
+        elif event.type == pygame.KEYDOWN and event.key in self.keys:
+            button = 1
+        elif event.type in self.redraw_events:
+            self.draw()
+        if button is None or self.page + 1 == len(self.pages):
+            return button
+        self.page += 1
+        self.draw()
+
+    def wait(self):
+        """Show the dialog until it is closed, the closing button"""
+        self.background = screen.copy()
+        self.draw()
+        while True:
+            button = self.poll()
+            if button is not None:
+                # время над диалогом run не догоняет, следующий clock.tick() считает от закрытия
+                clock.tick()
+                return button
+
+
+def text_screen(text, one_flip=False):
+    """Отображение текстовой информации, the button that closed it
+
+    one_flip only shows the text. Headless and scripted games do not wait for anybody,
+    so nothing is drawn for them - the next frame would cover the text anyway.
+    """
+    if one_flip:
+        Dialog(text).draw()
+        return
+    if HEADLESS or not controls.live:
+        return
+    return Dialog(text).wait()
+
+
+class CollisionGrid:
+    """Сетка клеток для поиска столкновений - sprites bucketed by tile cells"""
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def cells_of(self, rect):
+        size = self.cell_size
+        for cy in range(rect.top // size, (rect.bottom - 1) // size + 1):
+            for cx in range(rect.left // size, (rect.right - 1) // size + 1):
+                yield cx, cy
+
+    def add(self, sprite):
+        for cell in self.cells_of(sprite.rect):
+            self.cells.setdefault(cell, []).append(sprite)
+
+    def build(self, group):
+        self.cells.clear()
+        for sprite in group:
+            self.add(sprite)
+
+    def collideany(self, sprite, collided=None):
+        """Like pygame.sprite.spritecollideany, but checks only cells under sprite.rect"""
+        rect = sprite.rect
+        for cell in self.cells_of(rect):
+            for other in self.cells.get(cell, ()):
+                if (other.alive() and rect.colliderect(other.rect) and
+                        (collided is None or collided(sprite, other))):
+                    return other
+        return None
+
+    def collide_rect(self, rect):
+        """Any sprite whose rect intersects rect"""
+        for cell in self.cells_of(rect):
+            for other in self.cells.get(cell, ()):
+                if other.alive() and rect.colliderect(other.rect):
+                    return other
+        return None
+
+
+class FlowField:
+    """Поле путей к ёлке - BFS over free cells from the cells under targets, cached per level
+
+    next[i] is the cell to go to from cell i, -1 - no way. A cell under a target points
+    to itself, enemies there go straight to the target center kept in goal_x, goal_y.
+    """
+
+    def __init__(self, max_levels=4):
+        self.max_levels = max_levels
+        self.cache = OrderedDict()
+        self.width = self.height = 0
+        self.next = self.goal_x = self.goal_y = np.full(0, -1, np.int32)
+
+    def build(self, level, targets):
+        width, height = level.width, level.height
+        goals = {}
+        for rect in targets:
+            for y in range(max(0, rect.top // tile_height),
+                           min(height, (rect.bottom - 1) // tile_height + 1)):
+                for x in range(max(0, rect.left // tile_width),
+                               min(width, (rect.right - 1) // tile_width + 1)):
+                    goals[y * width + x] = rect.center
+        # порядок целей ключу не важен, сортировать их ради него незачем
+        key = (width, bytes(level.tiles), bytes(level.flags), frozenset(goals.items()))
+        self.width, self.height = width, height
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.next, self.goal_x, self.goal_y = self.cache[key]
+            return
+        free = [tile != NO_TILE and not flags for tile, flags in zip(level.tiles, level.flags)]
+        next_cell = [-1] * (width * height)
+        goal_x = np.zeros(width * height, np.int32)
+        goal_y = np.zeros(width * height, np.int32)
+        for cell, (x, y) in goals.items():
+            next_cell[cell] = cell
+            goal_x[cell], goal_y[cell] = x, y
+        queue = deque(sorted(goals))
+        while queue:
+            cell = queue.popleft()
+            x = cell % width
+            for other in (cell - width, cell + width, cell - 1 if x > 0 else -1,
+                          cell + 1 if x < width - 1 else -1):
+                if 0 <= other < len(free) and free[other] and next_cell[other] == -1:
+                    next_cell[other] = cell
+                    queue.append(other)
+        self.next, self.goal_x, self.goal_y = self.cache[key] = \
+            np.array(next_cell, np.int32), goal_x, goal_y
+        if len(self.cache) > self.max_levels:
+            self.cache.popitem(last=False)
+
+    def steer(self, x, y, size, vx, vy):
+        """Velocities of enemies at x, y - to the center line of their cell, then along the path
+
+        Enemies outside the field or with no way keep vx, vy.
+        """
+        w, h = size
+        center_x, center_y = x + w // 2, y + h // 2
+        column, row = center_x // tile_width, center_y // tile_height
+        inside = (column >= 0) & (column < self.width) & (row >= 0) & (row < self.height)
+        cell = np.where(inside, row * self.width + column, 0)
+        next_cell = np.where(inside, self.next[cell], -1)
+        # центры текущей и следующей клеток
+        cell_x, cell_y = column * tile_width + tile_width // 2, row * tile_height + tile_height // 2
+        next_x = next_cell % self.width * tile_width + tile_width // 2
+        next_y = next_cell // self.width * tile_height + tile_height // 2
+        across = next_x != cell_x
+        on_line = np.where(across, center_y == cell_y, center_x == cell_x)
+        new_vx = np.where(across, np.where(on_line, np.sign(next_x - center_x), 0),
+                          np.where(on_line, 0, np.sign(cell_x - center_x)))
+        new_vy = np.where(across, np.where(on_line, 0, np.sign(cell_y - center_y)),
+                          np.where(on_line, np.sign(next_y - center_y), 0))
+        # под целью - прямо к её центру
+        at_goal = inside & (next_cell == cell)
+        goal_x, goal_y = self.goal_x[cell], self.goal_y[cell]
+        new_vx = np.where(at_goal, np.sign(goal_x - center_x), new_vx)
+        new_vy = np.where(at_goal & (goal_x == center_x), np.sign(goal_y - center_y),
+                          np.where(at_goal, 0, new_vy))
+        way = next_cell >= 0
+        return np.where(way, new_vx, vx), np.where(way, new_vy, vy)
+
+
+class WalkableCells:
+    """Свободные клетки уровня - where quest items may be put, built once per level"""
+
+    def __init__(self):
+        self.cells = []
+
+    def build(self, level, grid, item_types=(6, 7)):
+        """Cells with a floor tile and no wall, item, tree or NPC under any of item_types
+        put in the middle of them"""
+        self.cells = []
+        rects = []
+        # меньший предмет внутри большего свободен, если свободен больший
+        for rect in sorted((pygame.Rect(FixedItem.center_offset(item_type),
+                                        FixedItem.images[item_type].get_size())
+                            for item_type in item_types), key=lambda rect: -rect.w * rect.h):
+            if not any(other.contains(rect) for other in rects):
+                rects.append(rect)
+        for i, (tile, flags) in enumerate(zip(level.tiles, level.flags)):
+            x, y = i % level.width, i // level.width
+            if tile != NO_TILE and not flags and not any(grid.collide_rect(
+                    rect.move(x * tile_width, y * tile_height)) for rect in rects):
+                self.cells.append((x, y))
+
+    def sample(self, count, spacing=0, away_from=None, distance=0, tries=20):
+        """count different cells, at least spacing cells apart and distance px from away_from
+
+        Every try is O(1). If count cells are not found in count * tries tries, spacing and
+        distance are halved and the search goes on, at last without them. Fewer cells are
+        returned only when the level has fewer than count, ValueError if it has none.
+        """
+        if not self.cells:
+            raise ValueError('no free cells to put items in')
+        chosen = []
+        taken = set()
+        while True:
+            for attempt in range(count * tries):
+                if len(chosen) == count:
+                    return chosen
+                x, y = cell = self.cells[rng.randrange(len(self.cells))]
+                if cell in taken:
+                    continue
+                if away_from is not None and ((x + 0.5) * tile_width - away_from[0]) ** 2 + (
+                        (y + 0.5) * tile_height - away_from[1]) ** 2 < distance ** 2:
+                    continue
+                if any(abs(x - x2) < spacing and abs(y - y2) < spacing for x2, y2 in chosen):
+                    continue
+                chosen.append(cell)
+                taken.add(cell)
+            if len(chosen) == count or not spacing and not distance:
+                break
+            spacing //= 2
+            distance //= 2
+        # без ограничений - оставшиеся свободные клетки по порядку, с случайного места
+        start = rng.randrange(len(self.cells))
+        for cell in self.cells[start:] + self.cells[:start]:
+            if len(chosen) == count:
+                break
+            if cell not in taken:
+                chosen.append(cell)
+                taken.add(cell)
+        return chosen
+
+
+class Pool:
+    """Пул объектов - killed objects are kept and reset instead of creating new ones"""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.free = []
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, *args, **kwargs):
+        if self.free:
+            obj = self.free.pop()
+            obj.reset(*args, **kwargs)
+            self.reused += 1
+        else:
+            obj = self.factory(*args, **kwargs)
+            self.created += 1
+        return obj
+
+    def release(self, obj):
+        self.free.append(obj)
+
+
+class TileLayer:
+    """Слой клеток кусками - chunks are rendered near the view and evicted by LRU"""
+
+    def __init__(self, chunk_size, max_chunks=16):
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.size = (0, 0)
+        self.sprites = {}
+        self.chunks = OrderedDict()
+
+    def build(self, *groups):
+        """Index static sprites by chunk, nothing is rendered here"""
+        self.sprites.clear()
+        self.chunks.clear()
+        width = height = 0
+        size = self.chunk_size
+        for group in groups:
+            for sprite in group:
+                rect = sprite.rect
+                width, height = max(width, rect.right), max(height, rect.bottom)
+                for cy in range(rect.top // size, (rect.bottom - 1) // size + 1):
+                    for cx in range(rect.left // size, (rect.right - 1) // size + 1):
+                        self.sprites.setdefault((cx, cy), []).append(sprite)
+        self.size = (width, height)
+
+    def render(self, cx, cy):
+        size = self.chunk_size
+        chunk = pygame.Surface((min(size, self.size[0] - cx * size),
+                                min(size, self.size[1] - cy * size)))
+        chunk.blits([(sprite.image, sprite.rect.move(-cx * size, -cy * size))
+                     for sprite in self.sprites.get((cx, cy), ())], False)
+        return chunk
+
+    def get(self, cx, cy):
+        chunk = self.chunks.get((cx, cy))
+        if chunk is None:
+            chunk = self.chunks[(cx, cy)] = self.render(cx, cy)
+            if len(self.chunks) > self.max_chunks:
+                self.chunks.popitem(last=False)
+        else:
+            self.chunks.move_to_end((cx, cy))
+        return chunk
+
+    def draw(self, surface, camera, margin=64):
+        """Blit chunks near the view, chunks coming into view are rendered in advance"""
+        size = self.chunk_size
+        left = max(0, (-camera.dx - margin) // size)
+        top = max(0, (-camera.dy - margin) // size)
+        right = min((self.size[0] - 1) // size, (-camera.dx + WIDTH + margin) // size)
+        bottom = min((self.size[1] - 1) // size, (-camera.dy + HEIGHT + margin) // size)
+        for cy in range(top, bottom + 1):
+            for cx in range(left, right + 1):
+                surface.blit(self.get(cx, cy), (cx * size + camera.dx, cy * size + camera.dy))
+
+
+class FrameCache:
+    """Кадры и маски листов - every sheet is cut once, frames and masks are shared"""
+
+    def __init__(self):
+        self.sheets = {}
+        self.masks = {}
+
+    def frames(self, sheet, rows, pix_x1=0, pix_y1=0, pix_x2=-1, pix_y2=-1):
+        """Same as cut_sheet, but cached per sheet"""
+        key = (sheet, tuple(rows), pix_x1, pix_y1, pix_x2, pix_y2)
+        if key not in self.sheets:
+            rect, frames = cut_sheet(sheet, rows, pix_x1, pix_y1, pix_x2, pix_y2)
+            for row in frames[0]:
+                for frame in row:
+                    self.masks[frame] = pygame.mask.from_surface(frame)
+            self.sheets[key] = rect, frames
+        rect, frames = self.sheets[key]
+        return rect.copy(), frames
+
+    def mask(self, frame):
+        return self.masks[frame]
+
+
+frame_cache = FrameCache()
 
 
 class AnimatedSprite(pygame.sprite.Sprite):
     def __init__(self, sheet, rows, x, y, *groups, pix_x1=0, pix_y1=0, pix_x2=-1, pix_y2=-1):
         super().__init__(all_sprites, *groups)
         self.rotated = 0
-        self.rect, self.frames = cut_sheet(sheet, rows, pix_x1, pix_y1, pix_x2, pix_y2)
+        self.rect, self.frames = frame_cache.frames(sheet, rows, pix_x1, pix_y1, pix_x2, pix_y2)
         self.cur_frame_row = 0
         self.cur_frame = 0
         self.image = self.frames[self.rotated][self.cur_frame_row][self.cur_frame]
@@ -104,6 +1033,11 @@ class AnimatedSprite(pygame.sprite.Sprite):
         self.cur_frame = (self.cur_frame + 1) % len(self.frames[self.rotated][self.cur_frame_row])
         self.image = self.frames[self.rotated][self.cur_frame_row][self.cur_frame]
 
+    @property
+    def mask(self):
+        """Mask of the frame shown now"""
+        return frame_cache.mask(self.image)
+
 
 class Tree(AnimatedSprite):
     """Новогодняя ёлка - sprite with health"""
@@ -121,57 +1055,71 @@ class Tree(AnimatedSprite):
 
 class Tile(pygame.sprite.Sprite):
     """Клетка - fixed sprite"""
-    images = cut_sheet(pygame.transform.scale(load_image('tiles3.png'), (64 * 9, 64 * 6)),
-                       [9] * 6)[1][0]
-    images2 = list(
-        map(lambda images_list: list(
-            map(lambda image: pygame.transform.scale(image, (64, 64)), images_list)),
-            cut_sheet(load_image('Tileset.png'),
-                      [3] * 3, pix_x2=16 * 3, pix_y2=16 * 3)[1][0]))
-    # transform all images to 64 x 64
-
-    images = (images[0] + images[1] + images[2] + images[3] + images[4] + images[5] + images2[0] +
-              images2[1] + images2[2])
+    images = []
+    masks = []
 
     def __init__(self, tile_type, pos_x, pos_y, *groups):
         super().__init__(all_sprites, tiles_group, *groups)
         self.image = self.images[tile_type]
+        self.mask = self.masks[tile_type]
         self.rect = self.image.get_rect().move(tile_width * pos_x, tile_height * pos_y)
 
 
 class FixedItem(pygame.sprite.Sprite):
-    """Fixed sprites"""
+    """Fixed sprites, take them from FixedItem.pool - killed items go back there"""
 
-    images = cut_sheet(load_image('Tileset.png'), [3, 3], 0, 16 * 7, 16 * 3, 16 * 9)[1][0]
-    images = images[0] + images[1]
-    images.append(load_image('spider_web.png'))
-    images = list(map(lambda image: pygame.transform.scale(image, (48, 48)), images))
-    images.append(load_image('mandarin.png'))
+    images = []
+    masks = []
 
     def __init__(self, item_type, pos_x, pos_y, *groups, add_x=0, add_y=0, collide=True):
+        super().__init__()
+        self.reset(item_type, pos_x, pos_y, *groups, add_x=add_x, add_y=add_y, collide=collide)
 
+    def reset(self, item_type, pos_x, pos_y, *groups, add_x=0, add_y=0, collide=True):
         # если должны быть boxes - т.е. не должны пересекаться с игроком
         if collide:
-            super().__init__(all_sprites, items_group, boxes_group, *groups)
+            self.add(all_sprites, items_group, boxes_group, *groups)
         else:
-            super().__init__(all_sprites, items_group, *groups)
+            self.add(all_sprites, items_group, *groups)
+        self.item_type = item_type
         self.image = self.images[item_type]
-        self.mask = pygame.mask.from_surface(self.image)
+        self.mask = self.masks[item_type]
         self.rect = self.image.get_rect().move(tile_width * pos_x + add_x,
                                                tile_height * pos_y + add_y)
 
+    def kill(self):
+        if self.alive():
+            super().kill()
+            self.pool.release(self)
+
+    @classmethod
+    def center_offset(cls, item_type):
+        """add_x, add_y that put an item of item_type in the middle of its cell"""
+        width, height = cls.images[item_type].get_size()
+        return (tile_width - width) // 2, (tile_height - height) // 2
+
+
+FixedItem.pool = Pool(FixedItem)
+
 
 class Player(AnimatedSprite):
     def __init__(self, sheet, rows, x, y):
         super().__init__(sheet, rows, x, y, player_group)
         self.v = 10
         self.iterations = 0
-        self.mask = pygame.mask.from_surface(self.image)
         self.frames = [self.frames[0][:8], self.frames[0][8:]]
         self.attacked = False
+        self.last_pos = self.rect.topleft
+
+    def lerp(self, alpha):
+        """Rect between previous and current simulation step"""
+        x, y = self.last_pos
+        return self.rect.move(round((x - self.rect.x) * (1 - alpha)),
+                              round((y - self.rect.y) * (1 - alpha)))
 
     def move(self):
-        keys = pygame.key.get_pressed()
+        self.last_pos = self.rect.topleft
+        keys = controls.pressed()
         if self.attacked or keys[pygame.K_f]:
             self.attack()
         change_x = change_y = 0
@@ -180,7 +1128,7 @@ class Player(AnimatedSprite):
         if keys[pygame.K_s] ^ keys[pygame.K_w]:
             change_y = -self.v if keys[pygame.K_w] else self.v
         self.rect.y += change_y
-        if pygame.sprite.spritecollideany(self, boxes_group, pygame.sprite.collide_mask):
+        if boxes_grid.collideany(self, pygame.sprite.collide_mask):
             self.rect.y -= change_y
             change_y = 0
 
@@ -188,7 +1136,7 @@ class Player(AnimatedSprite):
         if keys[pygame.K_a] ^ keys[pygame.K_d]:
             change_x += -self.v if keys[pygame.K_a] else self.v
         self.rect.x += change_x
-        if pygame.sprite.spritecollideany(self, boxes_group, pygame.sprite.collide_mask):
+        if boxes_grid.collideany(self, pygame.sprite.collide_mask):
             self.rect.x -= change_x
             change_x = 0
 
@@ -210,7 +1158,8 @@ class Player(AnimatedSprite):
             self.cur_frame = 0
             self.cur_frame_row = 2
         self.attacked = (self.attacked + 1) % 40
-        pygame.sprite.spritecollide(self, enemies_group, True)
+        for x, y in enemy_swarm.kill_colliding(self.rect):
+            particle_emitter.burst((x, y), 8, speed=4, image=1)
 
 
 class NPC(AnimatedSprite):
@@ -223,7 +1172,6 @@ class NPC(AnimatedSprite):
             super().__init__(sheet, [1], x, y, *groups, NPC_group)
         self.v = 15
         self.iterations = 0
-        self.mask = pygame.mask.from_surface(self.image)
 
 
 class Spawner(pygame.sprite.Sprite):
@@ -237,7 +1185,7 @@ class Spawner(pygame.sprite.Sprite):
         self.rotate = rotate
 
     def spawn_enemy(self):
-        Enemy(self.enemy_type, self.rect.x, self.rect.y, rotate=self.rotate)
+        enemy_swarm.spawn(self.enemy_type, self.rect.x, self.rect.y, self.rotate)
 
 
 class SpawnerGroup(pygame.sprite.Group):
@@ -253,95 +1201,309 @@ class SpawnerGroup(pygame.sprite.Group):
             spw.spawn_enemy()
 
 
-class Enemy(AnimatedSprite):
-    images = [[pygame.transform.scale(load_image('Enemy 06-1.png'), (48 * 3, 48 * 4)), [3] * 4],
-              [pygame.transform.scale(load_image('Enemy 04-1.png'), (48 * 3, 48 * 4)), [3] * 4],
-              [pygame.transform.scale(load_image('Enemy 05-1.png'), (48 * 3, 48 * 4)), [3] * 4],
-              [pygame.transform.scale(load_image('Enemy 03-1.png'), (48 * 3, 48 * 4)), [3] * 4]]
+class EnemySwarm:
+    """Все враги в массивах numpy - positions, velocities, types and frames
+
+    Alive enemies are the first count entries of every array, kills compact them in order.
+    last_x, last_y are positions before the last update, enemies are drawn between them and x, y.
+    """
+    # враги ходят раз в столько шагов
+    update_interval = 5
+    fields = ('ids', 'x', 'y', 'last_x', 'last_y', 'vx', 'vy', 'kind', 'damage', 'row', 'frame')
+
+    def __init__(self, capacity=256):
+        self.count = 0
+        self.next_id = 0
+        for field in self.fields:
+            setattr(self, field, np.zeros(capacity, np.int32))
+        self.frames = {}
+        self.size = (0, 0)
+
+    def __len__(self):
+        return self.count
+
+    def load_frames(self, enemy_type):
+        """Frames of enemy type as [row][frame], shared by all enemies of this type"""
+        sheet, rows = Enemy.images[enemy_type]
+        rect, frames = frame_cache.frames(sheet, rows)
+        self.frames[enemy_type] = frames[0]
+        self.size = rect.size
+
+    def grow(self, capacity=None):
+        capacity = capacity or 2 * len(self.x)
+        for field in self.fields:
+            array = getattr(self, field)
+            setattr(self, field, np.concatenate([array, np.zeros(capacity - len(array), np.int32)]))
+
+    def prepare(self, enemy_types, count):
+        """Cut frames of types and make room for count enemies before a wave comes"""
+        for enemy_type in enemy_types:
+            if enemy_type not in self.frames:
+                self.load_frames(enemy_type)
+        if len(self.x) < count:
+            self.grow(count)
+
+    def spawn(self, enemy_type, x, y, rotate=0):
+        if enemy_type not in self.frames:
+            self.load_frames(enemy_type)
+        if self.count == len(self.x):
+            self.grow()
+        i = self.count
+        self.ids[i] = self.next_id
+        self.x[i], self.y[i] = self.last_x[i], self.last_y[i] = x, y
+        self.vx[i], self.vy[i] = Enemy.speed_x[rotate], Enemy.speed_y[rotate]
+        self.kind[i] = enemy_type
+        self.damage[i] = Enemy.damages[enemy_type]
+        self.row[i] = rotate
+        self.frame[i] = 0
+        self.count += 1
+        self.next_id += 1
+        return self.next_id - 1
+
+    def remove(self, dead):
+        """Remove enemies where bool array dead is True"""
+        keep = ~dead
+        alive = int(keep.sum())
+        for field in self.fields:
+            array = getattr(self, field)
+            array[:alive] = array[:self.count][keep]
+        self.count = alive
+
+    def clear(self):
+        self.count = 0
+
+    def state(self):
+        """Copy of alive enemies for a snapshot"""
+        return self.next_id, {field: getattr(self, field)[:self.count].copy()
+                              for field in self.fields}
+
+    def restore(self, state):
+        self.next_id, arrays = state
+        self.count = len(arrays['ids'])
+        self.prepare(set(arrays['kind'].tolist()), self.count)
+        for field in self.fields:
+            getattr(self, field)[:self.count] = arrays[field]
+
+    def index(self, enemy_id):
+        found = np.flatnonzero(self.ids[:self.count] == enemy_id)
+        return int(found[0]) if len(found) else None
+
+    def overlap(self, rect):
+        """Bool array - enemies whose rects intersect rect"""
+        n = self.count
+        w, h = self.size
+        return ((self.x[:n] < rect.right) & (self.x[:n] + w > rect.left) &
+                (self.y[:n] < rect.bottom) & (self.y[:n] + h > rect.top))
+
+    def kill_colliding(self, rect):
+        """Kill enemies touching rect, centers of killed ones are returned"""
+        dead = self.overlap(rect)
+        if not dead.any():
+            return []
+        w, h = self.size
+        centers = list(zip((self.x[:self.count][dead] + w // 2).tolist(),
+                           (self.y[:self.count][dead] + h // 2).tolist()))
+        self.remove(dead)
+        return centers
+
+    def update(self):
+        n = self.count
+        if not n:
+            return
+        self.vx[:n], self.vy[:n] = flow_field.steer(self.x[:n], self.y[:n], self.size,
+                                                    self.vx[:n], self.vy[:n])
+        # строка кадров по направлению: вниз, влево, вправо, вверх
+        self.row[:n] = np.select([self.vy[:n] > 0, self.vx[:n] < 0, self.vx[:n] > 0,
+                                  self.vy[:n] < 0], [0, 1, 2, 3], self.row[:n])
+        self.last_x[:n], self.last_y[:n] = self.x[:n], self.y[:n]
+        self.x[:n] += self.vx[:n]
+        self.y[:n] += self.vy[:n]
+        for item in animated_items_group:
+            hit = self.overlap(item.rect)
+            if not hit.any():
+                continue
+            # маски текущих кадров проверяются только у врагов, задевших прямоугольник ёлки
+            for i in np.flatnonzero(hit):
+                frame = self.frames[self.kind[i]][self.row[i]][self.frame[i]]
+                if not frame_cache.mask(frame).overlap(
+                        item.mask, (item.rect.x - self.x[i], item.rect.y - self.y[i])):
+                    hit[i] = False
+            if hit.any():
+                tree.damage(int(self.damage[:n][hit].sum()))
+                self.remove(hit)
+                n = self.count
+        self.frame[:n] = (self.frame[:n] + 1) % 3
+
+    def visible(self, camera, step=1):
+        """(image, screen rect) of enemies inside the view, like Camera.visible
+
+        step - part of update_interval passed since the last update, 1 - draw at x, y.
+        """
+        view = pygame.Rect(-camera.dx, -camera.dy, WIDTH, HEIGHT)
+        w, h = self.size
+        on_screen = self.overlap(view)
+        positions = []
+        for now, last in ((self.x, self.last_x), (self.y, self.last_y)):
+            now, last = now[:self.count][on_screen], last[:self.count][on_screen]
+            positions.append((last + np.rint((now - last) * step).astype(np.int32)).tolist())
+        kinds, rows, frames = (array[:self.count][on_screen].tolist() for array in
+                               (self.kind, self.row, self.frame))
+        xs, ys = positions
+        return [(self.frames[kind][row][frame], pygame.Rect(x + camera.dx, y + camera.dy, w, h))
+                for kind, row, frame, x, y in zip(kinds, rows, frames, xs, ys)]
+
+    def draw(self, surface, camera, step=1):
+        surface.blits(self.visible(camera, step), False)
+
+
+class Enemy:
+    """Враг - view of one enemy stored in enemy_swarm"""
+
+    images = []
     damages = [1, 2, 3, 4]
     speed_x = [0, -1, 1, 0]
     speed_y = [1, 0, 0, -1]
 
-    def __init__(self, enemy_type, x, y, *groups, rotate=0):
-        super().__init__(self.images[enemy_type][0], self.images[enemy_type][1], x, y,
-                         enemies_group, *groups)
-        self.iterations = 0
-        self.damage = self.damages[enemy_type]
-        self.vx = self.speed_x[rotate]
-        self.vy = self.speed_y[rotate]
-        self.rotated = rotate
-        self.mask = pygame.mask.from_surface(self.image)
-        self.frames = [[self.frames[0][0]], [self.frames[0][1]], [self.frames[0][2]],
-                       [self.frames[0][3]]]
+    def __init__(self, enemy_type, x, y, rotate=0):
+        self.id = enemy_swarm.spawn(enemy_type, x, y, rotate)
 
-    def update(self):
-        self.rect.x += self.vx
-        self.rect.y += self.vy
-        if pygame.sprite.spritecollideany(self, animated_items_group, pygame.sprite.collide_mask):
-            self.rect.x -= self.vx
-            self.rect.y -= self.vy
-            tree.damage(self.damage)
-            self.kill()
-        super().update()
+    def alive(self):
+        return enemy_swarm.index(self.id) is not None
+
+    def kill(self):
+        i = enemy_swarm.index(self.id)
+        if i is not None:
+            dead = np.zeros(enemy_swarm.count, bool)
+            dead[i] = True
+            enemy_swarm.remove(dead)
+
+    def index(self):
+        """Row of the enemy in enemy_swarm, LookupError if it is dead"""
+        i = enemy_swarm.index(self.id)
+        if i is None:
+            raise LookupError(f'enemy {self.id} is dead')
+        return i
+
+    @property
+    def rect(self):
+        i = self.index()
+        return pygame.Rect((int(enemy_swarm.x[i]), int(enemy_swarm.y[i])), enemy_swarm.size)
+
+    @property
+    def damage(self):
+        return int(enemy_swarm.damage[self.index()])
 
 
 def generate_level(level):
-    """load sprites from level"""
-    new_player, new_tree, new_grandmother, x, y = None, None, None, None, None
+    """load sprites from compiled level"""
+    new_player, new_tree, new_grandmother = None, None, None
     x_player = y_player = None
-    for y in range(len(level)):
-        for x in range(len(level[y])):
-            if level[y][x].isdigit():
-                if int(level[y][x]) == 5:
-                    FixedItem(4, x - 1, y, add_x=48)
-                else:
-                    FixedItem(int(level[y][x]) - 1, x, y)
-                Tile(6 * 9 + 4, x, y)
-            elif level[y][x] == '@':
-                x_player = x
-                y_player = y
-                Tile(ord(level[y][x + 1]) - ord("A"), x, y)
-            elif level[y][x] == '=':
-                Tile(16, x, y)
-                new_tree = Tree(christmas_tree_image, [2], (x - 1) * tile_width,
-                                (y - 1) * tile_height, animated_items_group, boxes_group)
-            elif level[y][x] == '+':
-                Tile(40, x, y)
-                Spawner(x, y, 0, spawners_group, rotate=2)
-            elif level[y][x] == '-':
-                Tile(40, x, y)
-                Spawner(x, y, 0, spawners_group, rotate=1)
-            elif level[y][x] == '*':
-                Tile(40, x, y)
-                Spawner(x, y, 0, spawners_group, rotate=0)
-            elif level[y][x] == '/':
-                Tile(40, x, y)
-                Spawner(x, y, 0, spawners_group, rotate=3)
-            elif level[y][x] == "#":
-                Tile(ord(level[y - 1][x]) - ord("A"), x, y)
-                new_grandmother = NPC(grandmother_image, x * tile_width, y * tile_height,
-                                      boxes_group)
-            elif level[y][x] in ('K', "", "}"):
-                Tile(ord(level[y][x]) - ord('A'), x, y, boxes_group)
-            else:
-                Tile(ord(level[y][x]) - ord('A'), x, y)
+    width = level.width
+    for i, (tile, flags) in enumerate(zip(level.tiles, level.flags)):
+        if tile == NO_TILE:
+            continue
+        if flags & WALL:
+            Tile(tile, i % width, i // width, boxes_group)
+        else:
+            Tile(tile, i % width, i // width)
+    for x, y, rotate in level.spawners:
+        Spawner(x, y, 0, spawners_group, rotate=rotate)
+    for kind, item_type, x, y, add_x in level.entities:
+        if kind == ITEM:
+            FixedItem.pool.acquire(item_type, x, y, add_x=add_x)
+        elif kind == PLAYER:
+            x_player, y_player = x, y
+        elif kind == TREE:
+            new_tree = Tree(christmas_tree_image, [2], x * tile_width, y * tile_height,
+                            animated_items_group, boxes_group)
+        elif kind == GRANDMOTHER:
+            new_grandmother = NPC(grandmother_image, x * tile_width, y * tile_height,
+                                  boxes_group)
     new_player = Player(player_image, [13, 8, 10, 10, 10, 6, 4, 7] * 2, x_player * tile_width,
                         y_player * tile_height)
-    return new_player, new_grandmother, new_tree, x, y
+    boxes_grid.build(boxes_group)
+    tile_layer.build(tiles_group, items_group)
+    walkable_cells.build(level, boxes_grid)
+    flow_field.build(level, [item.rect for item in animated_items_group])
+    return new_player, new_grandmother, new_tree, level.width - 1, level.height - 1
 
 
 class Camera:
+    """Смещение вида - sprites stay in world coordinates"""
+
     def __init__(self):
         self.dx = 0
         self.dy = 0
 
     def apply(self, obj):
-        obj.rect.x += self.dx
-        obj.rect.y += self.dy
+        """Rect of obj on screen"""
+        return obj.rect.move(self.dx, self.dy)
+
+    def update(self, target, alpha=1):
+        """Center on target, alpha - part of the step passed since its last move"""
+        rect = target.lerp(alpha)
+        self.dx = -(rect.x + rect.w // 2 - WIDTH // 2)
+        self.dy = -(rect.y + rect.h // 2 - HEIGHT // 2)
+
+    def draw(self, group, surface):
+        """Draw group with view offset, rects of sprites are not changed"""
+        surface.blits([(sprite.image, sprite.rect.move(self.dx, self.dy)) for sprite in group],
+                      False)
 
-    def update(self, target):
-        self.dx = -(target.rect.x + target.rect.w // 2 - WIDTH // 2)
-        self.dy = -(target.rect.y + target.rect.h // 2 - HEIGHT // 2)
+    def visible(self, group):
+        """(image, screen rect) of sprites inside the view"""
+        view = pygame.Rect(-self.dx, -self.dy, WIDTH, HEIGHT)
+        return [(sprite.image, sprite.rect.move(self.dx, self.dy)) for sprite in group
+                if view.colliderect(sprite.rect)]
+
+
+class DirtyTracker:
+    """Changed regions of screen between two frames
+
+    When the view moves, the last frame is scrolled with it and only the uncovered strips are
+    redrawn besides sprites. regions are the clip rects to draw in: the strips and the union
+    of sprite rects. scrolled tells that the whole screen has to be shown.
+    """
+
+    def __init__(self):
+        self.rects = []
+        self.offset = None
+        self.full = True
+        self.scrolled = False
+        self.regions = []
+
+    def invalidate(self):
+        self.full = True
+
+    def update(self, camera, layers, *rects):
+        """Rects to redraw - old and new places of sprites and strips uncovered by scrolling"""
+        current = [rect for layer in layers for _, rect in layer]
+        current.extend(rects)
+        offset = (camera.dx, camera.dy)
+        dx, dy = (offset[0] - self.offset[0], offset[1] - self.offset[1]) if self.offset else (0, 0)
+        self.scrolled = bool(dx or dy)
+        # затемнение с виньеткой привязано к экрану, его сдвигать нельзя
+        if (self.full or self.offset is None or abs(dx) >= WIDTH or abs(dy) >= HEIGHT or
+                self.scrolled and not overlays.uniform()):
+            dirty = self.regions = [screen.get_rect()]
+        else:
+            strips = []
+            if self.scrolled:
+                screen.scroll(dx, dy)
+                if dx:
+                    strips.append(pygame.Rect(0 if dx > 0 else WIDTH + dx, 0, abs(dx), HEIGHT))
+                if dy:
+                    strips.append(pygame.Rect(0, 0 if dy > 0 else HEIGHT + dy, WIDTH, abs(dy)))
+            sprites = [rect.move(dx, dy) for rect in self.rects] + current
+            dirty = strips + sprites
+            self.regions = (strips + [sprites[0].unionall(sprites[1:])]) if sprites else strips
+        self.full = False
+        self.offset = offset
+        self.rects = current
+        return dirty
+
+
+dirty_tracker = DirtyTracker()
 
 
 class Interface(pygame.sprite.Sprite):
@@ -352,65 +1514,217 @@ class Interface(pygame.sprite.Sprite):
         self.image = pygame.Surface((50, 25))
         self.rect = self.image.get_rect()
         self.rect.move(200, 10)
+        self.time = None
 
     def apply(self, time):
         """Show time on left-up side"""
+        if time == self.time:
+            return
+        self.time = time
         self.image.fill((255, 255, 255))
-        font = pygame.font.Font(None, 30)
-        string_rendered = font.render(str(time // 60) + ":" + str(time % 60), 1,
-                                      pygame.Color('black'))
-        intro_rect = string_rendered.get_rect()
-        self.image.blit(string_rendered, intro_rect)
-
+        text_cache.blit_glyphs(self.image, str(time // 60) + ":" + str(time % 60), (0, 0),
+                               color='black')
 
-class Particle(pygame.sprite.Sprite):
-    """Частицы"""
-    fire = [load_image("star.png")]
-    for scale in (5, 10, 20):
-        fire.append(pygame.transform.scale(fire[0], (scale, scale)))
 
-    def __init__(self, pos, dx, dy, color=(255, 255, 0)):
-        super().__init__(all_sprites, other_group)
-        self.image = self.fire[0]
-        self.rect = self.image.get_rect()
+class Overlays:
+    """Затемнение экрана - tint, fade and vignette surfaces made once per resolution"""
 
-        self.velocity = [dx, dy]
-        self.rect.x, self.rect.y = pos
-        self.gravity = 1
-        self.iterations = 0
+    def __init__(self):
+        self.size = None
+        self.surfaces = {}
+        self.alphas = {}
+        self.transitions = {}
+        self.time = 0
+
+    def make(self, kind, size):
+        if kind == 'vignette':
+            surface = pygame.Surface(size, pygame.SRCALPHA)
+            steps = 32
+            for i in range(steps):
+                rect = pygame.Rect(0, 0, size[0] * (steps - i) // steps * 3 // 2,
+                                   size[1] * (steps - i) // steps * 3 // 2)
+                rect.center = (size[0] // 2, size[1] // 2)
+                pygame.draw.ellipse(surface, (0, 0, 0, 255 * max(0, steps - 2 * i) // steps), rect)
+            return surface
+        surface = pygame.Surface(size)
+        surface.fill((0, 0, 0))
+        return surface
+
+    def get(self, kind, size):
+        if size != self.size:
+            self.surfaces.clear()
+            self.size = size
+        if kind not in self.surfaces:
+            self.surfaces[kind] = self.make(kind, size)
+        return self.surfaces[kind]
+
+    def set(self, kind, alpha):
+        self.transitions.pop(kind, None)
+        self.alphas[kind] = alpha
+        dirty_tracker.invalidate()
+
+    def fade_to(self, kind, alpha, duration):
+        """Smooth change of layer alpha during duration ticks"""
+        self.transitions[kind] = (self.time, duration, self.alphas.get(kind, 0), alpha)
+
+    def clear(self):
+        self.alphas.clear()
+        self.transitions.clear()
+        dirty_tracker.invalidate()
+
+    def uniform(self):
+        """True if layers shown now are the same all over the screen, so they may be scrolled"""
+        return not self.alphas.get('vignette')
+
+    def state(self):
+        return dict(self.alphas), dict(self.transitions)
+
+    def restore(self, state):
+        self.alphas, self.transitions = dict(state[0]), dict(state[1])
+        dirty_tracker.invalidate()
+
+    def update(self, time):
+        """Move transitions to time, True if some alpha changed"""
+        self.time = time
+        changed = False
+        for kind, (start, duration, alpha_from, alpha_to) in list(self.transitions.items()):
+            part = min(1, (time - start) / duration) if duration else 1
+            alpha = round(alpha_from + (alpha_to - alpha_from) * part)
+            changed = changed or alpha != self.alphas.get(kind)
+            self.alphas[kind] = alpha
+            if part == 1:
+                del self.transitions[kind]
+        return changed
+
+    def draw(self, surface, time):
+        self.update(time)
+        for kind, alpha in self.alphas.items():
+            if alpha > 0:
+                layer = self.get(kind, surface.get_size())
+                if layer.get_alpha() != alpha:
+                    layer.set_alpha(alpha)
+                surface.blit(layer, (0, 0))
+
+
+overlays = Overlays()
+
+
+class ParticleEmitter:
+    """Частицы в массивах - fixed capacity, gravity is integrated for all particles at once"""
+
+    def __init__(self, capacity=1024, lifetime=15, gravity=1):
+        self.count = 0
+        self.lifetime = lifetime
+        self.gravity = gravity
+        self.pos = np.zeros((capacity, 2), np.int32)
+        self.velocity = np.zeros((capacity, 2), np.int32)
+        self.age = np.zeros(capacity, np.int32)
+        self.image = np.zeros(capacity, np.int32)
+
+    def __len__(self):
+        return self.count
+
+    def emit(self, pos, velocities, image=0):
+        """New particles at pos, extra ones are dropped when emitter is full"""
+        velocities = velocities[:len(self.age) - self.count]
+        new = slice(self.count, self.count + len(velocities))
+        self.pos[new] = pos
+        self.velocity[new] = velocities
+        self.age[new] = 0
+        self.image[new] = image
+        self.count += len(velocities)
+
+    def burst(self, pos, count, speed=6, image=0):
+        self.emit(pos, [(rng.randint(-speed, speed - 1), rng.randint(-speed, speed - 1))
+                        for _ in range(count)], image)
+
+    def clear(self):
+        self.count = 0
+
+    def state(self):
+        """Copy of alive particles for a snapshot"""
+        n = self.count
+        return self.pos[:n].copy(), self.velocity[:n].copy(), self.age[:n].copy(), \
+            self.image[:n].copy()
+
+    def restore(self, state):
+        self.count = len(state[0])
+        for array, saved in zip((self.pos, self.velocity, self.age, self.image), state):
+            array[:self.count] = saved
 
     def update(self):
-        self.iterations += 1
-        self.velocity[1] += self.gravity
-        self.rect.x += self.velocity[0]
-        self.rect.y += self.velocity[1]
-        if self.iterations == 15:
-            self.kill()
+        n = self.count
+        if not n:
+            return
+        self.age[:n] += 1
+        self.velocity[:n, 1] += self.gravity
+        self.pos[:n] += self.velocity[:n]
+        alive = self.age[:n] < self.lifetime
+        if not alive.all():
+            self.count = int(alive.sum())
+            for array in (self.pos, self.velocity, self.age, self.image):
+                array[:self.count] = array[:n][alive]
+
+    def visible(self, camera):
+        """(image, screen rect) of particles, like Camera.visible"""
+        images = Particle.fire
+        view = pygame.Rect(-camera.dx, -camera.dy, WIDTH, HEIGHT)
+        on_screen = []
+        for (x, y), image in zip(self.pos[:self.count].tolist(), self.image[:self.count].tolist()):
+            rect = images[image].get_rect(topleft=(x, y))
+            if view.colliderect(rect):
+                on_screen.append((images[image], rect.move(camera.dx, camera.dy)))
+        return on_screen
+
+    def draw(self, surface, camera):
+        surface.blits(self.visible(camera), False)
+
+
+class Particle:
+    """Частицы - images, state of particles is kept in particle_emitter"""
+
+    fire = []
+
+    def __init__(self, pos, dx, dy, color=(255, 255, 0)):
+        particle_emitter.emit(pos, [(dx, dy)])
 
 
 def game_end(time):
     if time % 15 != 0:
         return True
     numbers = range(-6, 6)
-    for _ in range(3):
-        Particle((tree.rect.x + 50, tree.rect.y - 20), choice(numbers), choice(numbers))
+    particle_emitter.emit((tree.rect.x + 50, tree.rect.y - 20),
+                          [(rng.choice(numbers), rng.choice(numbers)) for _ in range(3)])
     return True
 
 
-text_screen(["Предыстория...",
-             '',
-             "Ура! Новогодние праздники начались!",
-             "Вы как прилежный внук, конечно же,",
-             "решили навестить вашу бабушку!",
-             ])
+def init_images():
+    """Картинки классов из загруженного атласа"""
+    global player_image, christmas_tree_image, grandmother_image
+    Tile.images = atlas['tiles']
+    Tile.masks = [pygame.mask.from_surface(image) for image in Tile.images]
+    FixedItem.images = atlas['items']
+    FixedItem.masks = [pygame.mask.from_surface(image) for image in FixedItem.images]
+    Enemy.images = [[sheet, [3] * 4] for sheet in atlas['enemies']]
+    Particle.fire = atlas['fire']
+    player_image = atlas['player'][0]
+    christmas_tree_image = atlas['christmas_tree'][0]
+    grandmother_image = atlas['grandmother'][0]
+
+
+def wait_assets(*names):
+    """Экран загрузки, пока не готово нужное для первой сцены"""
+    if HEADLESS:
+        for name in names:
+            loader.result(name)
+        return
+    while not loader.ready(*names):
+        screen.fill((0, 0, 0))
+        dialog = Dialog([f'Загрузка... {round(loader.progress() * 100)}%'])
+        dialog.draw()
+        # процент обновляется по таймауту ожидания или раньше, если пришло событие
+        dialog.poll()
 
-player_image = pygame.transform.scale(load_image('player.png'), (64 * 13, 64 * 16))
-christmas_tree_image = load_image('christmas_tree_w_snow.png')
-grandmother_image = pygame.transform.scale(load_image('grandmother.png').
-                                           subsurface(pygame.Rect((0, 0), (32, 32))), (48, 48))
-
-pygame.mixer.init()
-pygame.mixer_music.load('data/music2.ogg')
 
 all_sprites = pygame.sprite.Group()
 NPC_group = pygame.sprite.Group()
@@ -420,282 +1734,722 @@ tiles_group = pygame.sprite.Group()
 boxes_group = pygame.sprite.Group()
 player_group = pygame.sprite.Group()
 other_group = pygame.sprite.Group()
-enemies_group = pygame.sprite.Group()
+enemy_swarm = EnemySwarm()
+particle_emitter = ParticleEmitter()
 interface_group = pygame.sprite.Group()
 spawners_group = SpawnerGroup()
 
 tile_width = tile_height = 64
-player, grandmother, tree, level_x, level_y = generate_level(load_level('map.txt'))
-screen2 = pygame.Surface((tile_width * level_x, tile_height * level_y))
+boxes_grid = CollisionGrid(tile_width)
+tile_layer = TileLayer(tile_width * 8)
+walkable_cells = WalkableCells()
+flow_field = FlowField()
+player = grandmother = tree = None
+level_x = level_y = 0
+
+
+def load_world(level):
+    """Убрать старый мир и создать новый из уровня"""
+    global player, grandmother, tree, level_x, level_y
+    for spr in all_sprites:
+        spr.kill()
+    enemy_swarm.clear()
+    particle_emitter.clear()
+    overlays.clear()
+    player, grandmother, tree, level_x, level_y = generate_level(level)
+
 
+class ProfileScope:
+    """Замер одного участка - adds its time to the profiler scope on exit"""
 
-def run(seconds, func):
-    pygame.mixer_music.play(-1)
-    start_tile = Tile(10, 0, 0, other_group)
+    def __init__(self, times, name):
+        self.times = times
+        self.name = name
 
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc):
+        self.times[self.name] = self.times.get(self.name, 0) + perf_counter() - self.start
+
+
+class Profiler:
+    """Профилировщик кадра - named timing scopes, on-screen overlay and JSON-lines records
+
+    When both the overlay and the records are off, scope() returns one shared null context,
+    so the instrumented code costs only a method call.
+    """
+    null_scope = nullcontext()
+    line_height = 16
+
+    def __init__(self):
+        self.enabled = False
+        self.show = False
+        self.records = None
+        self.frame = 0
+        self.times = {}
+        self.average = {}
+        self.counts = {}
+        self.loads = {}
+        self.image = None
+        self.rect = pygame.Rect(0, 0, 0, 0)
+
+    def scope(self, name):
+        if not self.enabled:
+            return self.null_scope
+        return ProfileScope(self.times, name)
+
+    def open(self, filename):
+        """Write a JSON line for every frame"""
+        self.records = open(filename, 'w', encoding='utf8')
+        self.enabled = True
+
+    def close(self):
+        if self.records is not None:
+            self.records.close()
+            self.records = None
+        self.enabled = self.show
+
+    def loaded(self, name, seconds):
+        """Time of a background load, goes to the record of the next frame"""
+        if self.records is not None:
+            self.loads[name] = round(seconds * 1000, 4)
+
+    def toggle(self):
+        """Show or hide the overlay"""
+        self.show = not self.show
+        self.enabled = self.show or self.records is not None
+        self.rect = pygame.Rect(0, 0, 0, 0)
+        self.image = None
+
+    def end_frame(self, time):
+        if not self.enabled:
+            return
+        self.frame += 1
+        self.counts = {'sprites': len(all_sprites), 'animated': len(animated_items_group),
+                       'npc': len(NPC_group), 'other': len(other_group),
+                       'enemies': enemy_swarm.count, 'particles': particle_emitter.count}
+        if self.records is not None:
+            record = {'frame': self.frame, 'tick': time,
+                      'ms': {name: round(seconds * 1000, 4) for name, seconds in self.times.items()},
+                      'counts': self.counts}
+            if self.loads:
+                # потоки загрузки добавляют в новый словарь, этот уже только наш
+                record['loads'], self.loads = self.loads, {}
+            self.records.write(json.dumps(record) + '\n')
+        if self.show:
+            for name, seconds in self.times.items():
+                self.average[name] = self.average.get(name, seconds) * 0.9 + seconds * 0.1
+        self.times = {}
+
+    def draw(self, surface):
+        """Overlay with average ms of scopes and sprite counts, redrawn every 15 frames"""
+        if not self.show:
+            return
+        if self.image is None or self.frame % 15 == 0:
+            lines = [f'{name} {seconds * 1000:.2f}' for name, seconds in self.average.items()]
+            lines += [f'#{name} {count}' for name, count in self.counts.items()]
+            self.image = pygame.Surface((130, len(lines) * self.line_height + 4))
+            self.image.set_alpha(200)
+            for i, line in enumerate(lines):
+                text_cache.blit_glyphs(self.image, line, (4, 2 + i * self.line_height), size=18)
+            self.rect = self.image.get_rect(topright=(WIDTH, 0))
+        surface.blit(self.image, self.rect)
+
+
+profiler = Profiler()
+
+
+class FrameStats:
+    """Время кадров - work time of every frame without waiting for the clock"""
+
+    def __init__(self):
+        self.times = []
+
+    def add(self, seconds):
+        self.times.append(seconds)
+
+    def report(self):
+        """Frame count and mean, percentiles and max in ms"""
+        if not self.times:
+            return {'frames': 0}
+        times = np.array(self.times) * 1000
+        p50, p95, p99 = np.percentile(times, (50, 95, 99))
+        return {'frames': len(times), 'mean': round(float(times.mean()), 3),
+                'p50': round(float(p50), 3), 'p95': round(float(p95), 3),
+                'p99': round(float(p99), 3), 'max': round(float(times.max()), 3)}
+
+
+frame_stats = FrameStats()
+
+
+def run(seconds, func, start=0):
+    """Игровой цикл с тика start до seconds игровых секунд, 0 - если func сказала, что проиграли"""
     camera = Camera()
 
     all_sprites.update()
-    tiles_group.draw(screen2)
-    items_group.draw(screen2)
-    iterations = 0
-    time = 0
+    time = start
+    # накопленное время в мс * SIM_RATE, шаг симуляции - 1000
+    accumulator = 0
 
     interface = Interface()
     interface_group.update()
-    interface.apply(0)
+    interface.apply(time // 45)
+    clock.tick()
     while time < seconds * 45:
-        time += 1
-        interface.apply(time // 45)
-        screen.fill((255, 255, 255))
-
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
+        with profiler.scope('events'):
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    terminate()
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                    profiler.toggle()
+                    dirty_tracker.invalidate()
+
+        with profiler.scope('tick'):
+            if HEADLESS:
+                # ровно один шаг за цикл, без ожидания реального времени
+                accumulator += 1000
+            else:
+                accumulator += min(clock.tick(FPS), MAX_FRAME_TIME) * SIM_RATE
+        frame_start = perf_counter()
+        while accumulator >= 1000 and time < seconds * 45:
+            accumulator -= 1000
+            time += 1
+            with profiler.scope('move'):
+                player.move()
+            if controls.finished:
+                # сценарий или запись ввода закончились - как закрытие окна
                 terminate()
-        player.move()
-        camera.update(player)
-
-        iterations = (iterations + 1) % 5
-        if iterations == 0:
-            enemies_group.update()
-            animated_items_group.update()
-            other_group.update()
-        for sprite in all_sprites:
-            camera.apply(sprite)
-
-        screen.blit(screen2, (start_tile.rect.x, start_tile.rect.y))
-        animated_items_group.draw(screen)
-        NPC_group.draw(screen)
-        other_group.draw(screen)
-        player_group.draw(screen)
-        enemies_group.draw(screen)
-        interface_group.draw(screen)
-
-        if not func(time):
-            screen.fill((0, 0, 0))
-            return 0
-
-        clock.tick(FPS)
-        pygame.display.flip()
+
+            if time % enemy_swarm.update_interval == 0:
+                with profiler.scope('enemies'):
+                    enemy_swarm.update()
+                with profiler.scope('animation'):
+                    animated_items_group.update()
+                    other_group.update()
+                with profiler.scope('particles'):
+                    particle_emitter.update()
+
+            with profiler.scope('quests'):
+                lost = not func(time)
+            if lost:
+                # кадр проигрыша тоже закрываем, иначе его замеры уйдут в следующий run
+                screen.fill((0, 0, 0))
+                frame_stats.add(perf_counter() - frame_start)
+                profiler.end_frame(time)
+                return 0
+
+        if RENDER_MODE == 'none':
+            frame_stats.add(perf_counter() - frame_start)
+            profiler.end_frame(time)
+            continue
+        with profiler.scope('camera'):
+            alpha = accumulator / 1000
+            interface.apply(time // 45)
+            camera.update(player, alpha)
+            player_layer = [(sprite.image, sprite.lerp(alpha).move(camera.dx, camera.dy))
+                            for sprite in player_group]
+            # враги между двумя своими обновлениями, как игрок между шагами
+            enemy_step = (time % enemy_swarm.update_interval + alpha) / enemy_swarm.update_interval
+
+        with profiler.scope('draw'):
+            if RENDER_MODE == 'dirty':
+                layers = [camera.visible(group) for group in (animated_items_group, NPC_group,
+                                                              other_group)]
+                layers.append(particle_emitter.visible(camera))
+                layers.append(player_layer)
+                layers.append(enemy_swarm.visible(camera, enemy_step))
+                if overlays.update(time):
+                    dirty_tracker.invalidate()
+                dirty = dirty_tracker.update(camera, layers, interface.rect, profiler.rect)
+                for region in dirty_tracker.regions:
+                    screen.set_clip(region)
+                    screen.fill((255, 255, 255))
+                    tile_layer.draw(screen, camera)
+                    for layer in layers:
+                        screen.blits(layer, False)
+                    interface_group.draw(screen)
+                    overlays.draw(screen, time)
+                    profiler.draw(screen)
+                screen.set_clip(None)
+            else:
+                screen.fill((255, 255, 255))
+                tile_layer.draw(screen, camera)
+                camera.draw(animated_items_group, screen)
+                camera.draw(NPC_group, screen)
+                camera.draw(other_group, screen)
+                particle_emitter.draw(screen, camera)
+                screen.blits(player_layer, False)
+                enemy_swarm.draw(screen, camera, enemy_step)
+                interface_group.draw(screen)
+                overlays.draw(screen, time)
+                profiler.draw(screen)
+
+        with profiler.scope('flip'):
+            if RENDER_MODE == 'dirty' and not dirty_tracker.scrolled:
+                pygame.display.update(dirty)
+            else:
+                pygame.display.flip()
+        frame_stats.add(perf_counter() - frame_start)
+        profiler.end_frame(time)
     return 1
 
 
-class QuestCookies:
+class Timeline:
+    """Расписание игры - heap of timed events and triggers checked every tick
+
+    Timed events fire at or after their time, in order of time and registration.
+    A trigger fires once, on the first tick its condition is true. When nothing is due,
+    update() costs one look at the heap and one call per active trigger.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.pending = set()
+        self.triggers = {}
+        self.next_id = 0
+
+    def at(self, time, callback, owner=None):
+        """callback(time) on the first update at or after time"""
+        self.next_id += 1
+        heapq.heappush(self.events, (time, self.next_id, owner, callback))
+        self.pending.add(self.next_id)
+        return self.next_id
+
+    def when(self, condition, callback, owner=None):
+        """callback(time) once condition(time) is true"""
+        self.next_id += 1
+        self.triggers[self.next_id] = (owner, condition, callback)
+        return self.next_id
+
+    def near(self, sprite, target, squared_distance, callback, owner=None):
+        """callback(time) once sprite comes to target, distance is between top-left corners"""
+        return self.when(lambda time: (sprite.rect.x - target.rect.x) ** 2 + (
+            sprite.rect.y - target.rect.y) ** 2 < squared_distance, callback, owner)
+
+    def drop(self, owner):
+        """Forget all events and triggers of owner"""
+        self.pending.difference_update(event_id for _, event_id, event_owner, _ in self.events
+                                       if event_owner is owner)
+        for trigger_id in [trigger_id for trigger_id, (trigger_owner, _, _) in
+                           self.triggers.items() if trigger_owner is owner]:
+            del self.triggers[trigger_id]
+
+    def update(self, time):
+        """Fire triggers and due events, again while the fired ones add something due now"""
+        fired = True
+        while fired:
+            fired = False
+            for trigger_id, (_, condition, callback) in list(self.triggers.items()):
+                if trigger_id in self.triggers and condition(time):
+                    del self.triggers[trigger_id]
+                    callback(time)
+                    fired = True
+            while self.events and self.events[0][0] <= time:
+                _, event_id, _, callback = heapq.heappop(self.events)
+                if event_id in self.pending:
+                    self.pending.remove(event_id)
+                    callback(time)
+                    fired = True
+
+    def state(self):
+        return list(self.events), set(self.pending), dict(self.triggers), self.next_id
+
+    def restore(self, state):
+        events, pending, triggers, self.next_id = state
+        self.events, self.pending, self.triggers = list(events), set(pending), dict(triggers)
+
+
+class Quest:
+    """Квест - its checks are registered in the timeline of the game, not run every tick"""
+
+    def __init__(self, time):
+        self.game = None
+        self.started = False
+        self.start_time = time
+        # текст, с которым квест выдан, его показывают снова при возврате к контрольной точке
+        self.prompt = None
+
+    def begin(self, game, time):
+        """Register checks until the start"""
+        self.game = game
+
+    def at(self, time, callback):
+        return self.game.timeline.at(time, callback, self)
+
+    def when(self, condition, callback):
+        return self.game.timeline.when(condition, callback, self)
+
+    def near(self, target, squared_distance, callback):
+        return self.game.timeline.near(player, target, squared_distance, callback, self)
+
+    def finish(self, time):
+        self.game.timeline.drop(self)
+        self.end()
+        self.game.quest_done(time)
+
+    def fail(self, time):
+        self.game.timeline.drop(self)
+        self.game.lost = True
+
+    def end(self):
+        pass
+
+
+class QuestCookies(Quest):
     """Квест - собрать печенки"""
 
     def __init__(self, count, time):
+        super().__init__(time)
         self.count = count
         self.count_cookies = 0
         self.group = pygame.sprite.Group()
-        self.started = False
-        self.start_time = time
-
-    def check(self, time):
-        """Проверка на начало игры"""
-        if self.started:
-            return 1
 
+    def begin(self, game, time):
+        super().begin(game, time)
         # проигрыш если не успел подойти к бабушке
-        if time - self.start_time > 45 * 45:
-            return 2
-        if (player.rect.x - grandmother.rect.x) ** 2 + (
-                player.rect.y - grandmother.rect.y) ** 2 < 5000:
-            self.start(time)
-            return 1
-        return 0
+        self.at(time + 45 * 45 + 1, self.fail)
+        self.near(grandmother, 5000, self.start)
 
     def start(self, time):
+        cells = walkable_cells.sample(self.count, spacing=2, away_from=player.rect.center,
+                                      distance=3 * tile_width)
+        # на маленькой карте клеток может не хватить - собрать нужно столько, сколько есть
+        self.count = len(cells)
         text_screen(["Бабушка просит вас найти",
                      "её потерянные мандарины!",
                      "Пожалуйста помогите ей!",
                      f'Их ровно {self.count} штук.'])
+        self.game.timeline.drop(self)
         self.start_time = time
         self.started = True
-        for i in range(self.count):
-            x = randint(-level_x, level_x)
-            y = randint(-level_y, level_y)
-            cookie = FixedItem(7, x, y, self.group, other_group, collide=False)
-            while (pygame.sprite.spritecollideany(cookie, boxes_group, False) or
-                   not len(pygame.sprite.spritecollide(cookie, tiles_group, False))):
-                cookie.rect.x = randint(-level_x * tile_width, level_x * tile_width)
-                cookie.rect.y = randint(-level_y * tile_height, level_y * tile_height)
-
-    def __call__(self, time):
-        if time - self.start_time > 45 * 45:
-            return 2
+        add_x, add_y = FixedItem.center_offset(7)
+        for x, y in cells:
+            FixedItem.pool.acquire(7, x, y, self.group, other_group, add_x=add_x, add_y=add_y,
+                                   collide=False)
+        self.at(time + 45 * 45 + 1, self.fail)
+        self.when(self.collect, self.finish)
+
+    def collect(self, time):
         self.count_cookies += \
             len(pygame.sprite.spritecollide(player, self.group, True, pygame.sprite.collide_mask))
-        return 1 if self.count == self.count_cookies else 0
+        return self.count == self.count_cookies
 
     def end(self):
         text_screen(['Молодчинка!', 'Ты нашел все мандаринки!'])
 
 
-class QuestNight:
-    """Квест - пережить ночь"""
+class QuestNight(Quest):
+    """Квест - пережить ночь
+
+    Lengths are in ticks, they and the health of the tree can be changed for balance runs.
+    Waves after the first come up to wave_jitter ticks earlier or later, drawn from rng.
+    """
+    duration = 150 * 45
+    spawn_interval = 15 * 45
+    wave_jitter = 0
+    tree_health = 30
 
     def __init__(self, num, time):
+        if not 0 <= num < len(ENEMY_SHEETS) - 1:
+            raise ValueError(f'night enemy type must be 0..{len(ENEMY_SHEETS) - 2}, not {num}')
+        super().__init__(time)
         self.enemy_type = num
+        self.waves = 0
         spawners_group.apply(num)
-        self.start_time = time
-        self.started = False
-        tree.health = 30
+        # все волны ночи помещаются в заранее выделенные массивы
+        enemy_swarm.prepare((num, num + 1),
+                            len(spawners_group) * (self.duration // self.spawn_interval))
+        tree.health = self.tree_health
 
-    # проигрыш если не успел подойти к ёлке
-    def check(self, time):
-        if self.started:
-            return 1
-        if time - self.start_time > 45 * 45:
-            return 2
-        if (player.rect.x - tree.rect.x) ** 2 + (
-                player.rect.y - tree.rect.y) ** 2 < 10000:
-            self.start(time)
-            return 1
-        return 0
+    def begin(self, game, time):
+        super().begin(game, time)
+        # проигрыш если не успел подойти к ёлке
+        self.at(time + 45 * 45 + 1, self.fail)
+        self.near(tree, 10000, self.start)
 
     def start(self, time):
+        self.game.timeline.drop(self)
         self.started = True
         self.start_time = time
-        pygame.mixer_music.load('data/music1.ogg')
-        pygame.mixer_music.play(-1)
-
-    def __call__(self, time):
-        black_surf = pygame.Surface(SIZE)
-        black_surf.fill((0, 0, 0))
-        black_surf.set_alpha(60)
-        screen.blit(black_surf, (0, 0))
-        if tree.get_health() <= 0:
-            return 2
-        if time - self.start_time == 75 * 45:
-            spawners_group.apply(self.enemy_type + 1)
-        if (time - self.start_time) % (15 * 45) == 0:
-            spawners_group.spawn_enemies()
-        if time - self.start_time == 150 * 45:
-            return 1
-        return 0
+        audio.play('music1.ogg')
+        overlays.fade_to('tint', 60, 3 * 45)
+        self.when(lambda time: tree.get_health() <= 0, self.fail)
+        self.at(time + self.duration // 2, self.switch)
+        self.at(time + self.duration, self.finish)
+        self.wave(time)
+
+    def switch(self, time):
+        spawners_group.apply(self.enemy_type + 1)
+
+    def wave(self, time):
+        spawners_group.spawn_enemies()
+        self.waves += 1
+        next_wave = self.start_time + self.waves * self.spawn_interval
+        if next_wave < self.start_time + self.duration:
+            if self.wave_jitter:
+                next_wave = max(time + 1, next_wave + rng.randint(-self.wave_jitter,
+                                                                  self.wave_jitter))
+            self.at(next_wave, self.wave)
 
     def end(self):
-        tree.health = 30
-        for spr in enemies_group:
-            spr.kill()
+        tree.health = self.tree_health
+        enemy_swarm.clear()
+        overlays.fade_to('tint', 0, 3 * 45)
         text_screen(['Поздравляем ночь пройдена!'])
-        pygame.mixer_music.load('data/music2.ogg')
-        pygame.mixer_music.play(-1)
+        audio.play('music2.ogg')
 
 
-class QuestSpiderWeb:
+class QuestSpiderWeb(Quest):
     """Квест - собрать паутину"""
 
     def __init__(self, count, time):
+        super().__init__(time)
         self.count = count
         self.count_webs = 0
         self.group = pygame.sprite.Group()
-        self.started = False
-        self.start_time = time
 
-    # проигрыш если не успел подойти к бабушке
-    def check(self, time):
-        if self.started:
-            return 1
-        if time - self.start_time > 45 * 45:
-            return 2
-        if (player.rect.x - grandmother.rect.x) ** 2 + (
-                player.rect.y - grandmother.rect.y) ** 2 < 5000:
-            self.start(time)
-            return 1
-        return 0
+    def begin(self, game, time):
+        super().begin(game, time)
+        # проигрыш если не успел подойти к бабушке
+        self.at(time + 45 * 45 + 1, self.fail)
+        self.near(grandmother, 5000, self.start)
 
     def start(self, time):
         text_screen(["Похоже где-то завелся паук!",
                      "Бабушка думает,", "что если убрать всю паутину",
                      "Паук обязательно убежит!", "Поэтому, пожалуйста, уберите её",
                      "Чтобы убрать паутину вам следует ударить её!"])
+        self.game.timeline.drop(self)
         self.start_time = time
         self.started = True
-        for i in range(self.count):
-            x = randint(-level_x, level_x)
-            y = randint(-level_y, level_y)
-            web = FixedItem(6, x, y, self.group, other_group, collide=False)
-
-            # если пересекается с каким то недостижимым объектом или непересекается ни с чем
-            while (pygame.sprite.spritecollideany(web, boxes_group, False) or
-                   not len(pygame.sprite.spritecollide(web, tiles_group, False))):
-                web.rect.x = randint(-level_x * tile_width, level_x * tile_width)
-                web.rect.y = randint(-level_y * tile_height, level_y * tile_height)
-
-    def __call__(self, time):
-        if time - self.start_time > 45 * 45:
-            return 2
+        # только клетки, где паутина не пересекается с недостижимыми объектами
+        cells = walkable_cells.sample(self.count, spacing=2, away_from=player.rect.center,
+                                      distance=3 * tile_width)
+        self.count = len(cells)
+        add_x, add_y = FixedItem.center_offset(6)
+        for x, y in cells:
+            FixedItem.pool.acquire(6, x, y, self.group, other_group, add_x=add_x, add_y=add_y,
+                                   collide=False)
+        self.at(time + 45 * 45 + 1, self.fail)
+        self.when(self.collect, self.finish)
+
+    def collect(self, time):
         if player.attacked:
             self.count_webs += \
                 len(pygame.sprite.spritecollide(player, self.group, True,
                                                 pygame.sprite.collide_mask))
-        return 1 if self.count == self.count_webs else 0
+        return self.count == self.count_webs
 
     def end(self):
         text_screen(['Молодчинка!', 'Паук сбежал!'])
 
 
-class Game:
-    quests = [QuestCookies, QuestNight, QuestSpiderWeb]
+class Snapshot:
+    """Снимок мира - only what changes while playing, tiles, grids and the tile layer stay"""
+
+    def __init__(self, time, game):
+        self.time = time
+        self.rng = rng.getstate()
+        self.player = (player.rect.topleft, player.rotated, player.cur_frame_row,
+                       player.cur_frame, player.attacked, player.iterations)
+        self.animations = [(sprite, sprite.rotated, sprite.cur_frame_row, sprite.cur_frame)
+                           for group in (animated_items_group, NPC_group) for sprite in group]
+        self.health = tree.health
+        self.spawners = [(spawner, spawner.enemy_type) for spawner in spawners_group]
+        self.enemies = enemy_swarm.state()
+        self.particles = particle_emitter.state()
+        self.overlays = overlays.state()
+        self.music = audio.track
+        self.timeline = game.timeline.state()
+        quest = game.current_quest
+        self.quest = None
+        if quest is not None:
+            # квест - его простые поля и предметы, сами спрайты вернутся в пул
+            fields = {name: value for name, value in vars(quest).items() if name != 'group'}
+            items = None
+            if hasattr(quest, 'group'):
+                items = [(item.item_type, item.rect.topleft) for item in quest.group]
+            self.quest = (quest, fields, items)
+
+    def restore(self, game):
+        """Return the world to the snapshot, it becomes the checkpoint of game
+
+        A quest that was given but not started shows its text again.
+        """
+        rng.setstate(self.rng)
+        topleft, player.rotated, player.cur_frame_row, player.cur_frame, player.attacked, \
+            player.iterations = self.player
+        player.rect.topleft = player.last_pos = topleft
+        player.image = player.frames[player.rotated][player.cur_frame_row][player.cur_frame]
+        for sprite, rotated, row, frame in self.animations:
+            sprite.rotated, sprite.cur_frame_row, sprite.cur_frame = rotated, row, frame
+            sprite.image = sprite.frames[rotated][row][frame]
+        tree.health = self.health
+        for spawner, enemy_type in self.spawners:
+            spawner.enemy_type = enemy_type
+        enemy_swarm.restore(self.enemies)
+        particle_emitter.restore(self.particles)
+        overlays.restore(self.overlays)
+
+        for item in list(other_group):
+            item.kill()
+        # события расписания ссылаются на тот же объект квеста, ему возвращаются поля
+        game.timeline.restore(self.timeline)
+        game.lost = False
+        game.current_quest = None
+        if self.quest is not None:
+            quest, fields, items = self.quest
+            game.current_quest = quest
+            quest.__dict__.clear()
+            quest.__dict__.update(fields)
+            if items is not None:
+                quest.group = pygame.sprite.Group()
+                for item_type, (x, y) in items:
+                    FixedItem.pool.acquire(item_type, 0, 0, quest.group, other_group,
+                                           add_x=x, add_y=y, collide=False)
+        audio.play(self.music)
+        game.checkpoint = self
+        quest = game.current_quest
+        if quest is not None and not quest.started and quest.prompt:
+            # игрок должен снова узнать, куда идти
+            text_screen(quest.prompt)
 
-    def __init__(self):
+
+class Game:
+    """Сценарий игры - quests are given by the timeline at their times"""
+    schedule = [(15 * 45, QuestCookies, 15, ['Бабушке срочно нужна ваша',
+                                             'помощь, скорее к ней!']),
+                (105 * 45, QuestNight, 0, ["Срочно беги к ёлке!",
+                                           'Кажется, её хотят сломать!']),
+                (300 * 45, QuestSpiderWeb, 15, ['Бабушке срочно нужна ваша',
+                                                'помощь, скорее к ней!']),
+                (390 * 45, QuestNight, 2, ["Срочно беги к ёлке!",
+                                           'Кажется, её снова хотят сломать!'])]
+
+    def __init__(self, schedule=None):
         self.current_quest = None
+        self.checkpoint = None
+        self.lost = False
+        self.timeline = Timeline()
+        for time, quest_type, arg, text in self.schedule if schedule is None else schedule:
+            self.timeline.at(time, partial(self.give, quest_type, arg, text))
+
+    def give(self, quest_type, arg, text, time):
+        if text:
+            text_screen(text)
+        if self.current_quest is not None:
+            self.timeline.drop(self.current_quest)
+        self.current_quest = quest_type(arg, time)
+        self.current_quest.prompt = text
+        self.current_quest.begin(self, time)
+        # контрольная точка - квест выдан, но ещё не начат
+        self.checkpoint = Snapshot(time, self)
+
+    def quest_done(self, time):
+        self.current_quest = None
+        self.checkpoint = Snapshot(time, self)
 
     def __call__(self, time):
-        if time == 15 * 45:
-            text_screen(['Бабушке срочно нужна ваша',
-                         'помощь, скорее к ней!'])
-            self.current_quest = self.quests[0](15, time)
-        if time == 105 * 45:
-            text_screen(["Срочно беги к ёлке!",
-                         'Кажется, её хотят сломать!'])
-            self.current_quest = self.quests[1](0, time)
-        if time == 300 * 45:
-            text_screen(['Бабушке срочно нужна ваша',
-                         'помощь, скорее к ней!'])
-            self.current_quest = self.quests[2](15, time)
-        if time == 390 * 45:
-            text_screen(["Срочно беги к ёлке!",
-                         'Кажется, её снова хотят сломать!'])
-            self.current_quest = self.quests[1](2, time)
-        if self.current_quest is not None:
-            chk = self.current_quest.check(time)
-            if chk == 0:
-                return True
-            elif chk == 2:
-                return False
-            res = self.current_quest(time)
-            if res == 1:
-                self.current_quest.end()
-                self.current_quest = None
-            return res != 2
-        return True
+        self.timeline.update(time)
+        return not self.lost
+
+
+def main(headless=False, input_source=None, restarts=None, seed=None):
+    """Вся игра - intro, quests and ending; True if the game was won
+
+    headless runs with no window and sound as fast as possible, dialogs are closed at once
+    and nothing is drawn unless RENDER_MODE is set.
+    restarts limits how many lost games are started again (None - no limit).
+    The same seed and input give the same game.
+    """
+    global controls, RENDER_MODE
+    init_display(headless)
+    # картинку без окна всё равно никто не увидит
+    if headless and 'RENDER_MODE' not in os.environ:
+        RENDER_MODE = 'none'
+    rng.seed(seed)
+    if input_source is not None:
+        controls = input_source
+    audio.init(not headless)
+
+    # первая сцена ждёт только атлас, карту и её музыку, остальное грузится дальше
+    loader.submit('atlas', atlas.read)
+    loader.submit('map.txt', load_compiled_level, 'map.txt')
+    audio.preload('music2.ogg', 'music1.ogg')
+    loader.submit('map_end.txt', load_compiled_level, 'map_end.txt')
+
+    text_screen(["Предыстория...",
+                 '',
+                 "Ура! Новогодние праздники начались!",
+                 "Вы как прилежный внук, конечно же,",
+                 "решили навестить вашу бабушку!",
+                 ])
+
+    wait_assets('atlas', 'map.txt', 'music2.ogg')
+    # картинки создаются только в главном потоке, в фоне был прочитан кэш
+    atlas.load(loader.result('atlas'))
+    init_images()
+
+    audio.play('music2.ogg', fade_ms=0)
+
+    load_world(loader.result('map.txt'))
+    game = Game()
+    beginning = game.checkpoint = Snapshot(0, game)
+
+    losses = 0
+    while run(500, game, game.checkpoint.time) == 0:
+        losses += 1
+        if restarts is not None and losses > restarts:
+            return False
+        button = controls.choose(text_screen(['К сожалению, вы проиграли!',
+                                              'Левая кнопка мыши -',
+                                              'с последней контрольной точки,',
+                                              'правая - с начала']))
+        (beginning if button == 3 else game.checkpoint).restore(game)
+
+    # Конец игры
+    audio.play('music1.ogg')
+    screen.fill((0, 0, 0))
+    text_screen(["Поздравляем!", "", 'Вы спасли новый год!', 'Бабушке было очень приятно',
+                 "провести время с вами!", "", "",
+                 "От лица авторов игры: ", "Мы желаем вам удачи,",
+                 "счастья и здоровья в Новом году!"])
+
+    load_world(loader.result('map_end.txt'))
+
+    run(30, func=game_end)
+    text_screen(["Конец!"])
+    return True
 
 
-while run(500, Game()) == 0:
-    text_screen(['К сожалению, вы проиграли!',
-                 'Чтобы начать с начала',
-                 'Нажмите любую кнопку мыши'])
-    for spr in all_sprites:
-        spr.kill()
-    player, grandmother, tree, level_x, level_y = generate_level(load_level('map.txt'))
-    screen2 = pygame.Surface((tile_width * level_x, tile_height * level_y))
-    pygame.mixer_music.load('data/music2.ogg')
-
-# Конец игры
-pygame.mixer_music.load('data/music1.ogg')
-for spr in all_sprites:
-    spr.kill()
-screen.fill((0, 0, 0))
-text_screen(["Поздравляем!", "", 'Вы спасли новый год!', 'Бабушке было очень приятно',
-             "провести время с вами!", "", "",
-             "От лица авторов игры: ", "Мы желаем вам удачи,",
-             "счастья и здоровья в Новом году!"])
-
-player, grandmother, tree, level_x, level_y = generate_level(load_level('map_end.txt'))
-screen2 = pygame.Surface((tile_width * level_x, tile_height * level_y))
-
-run(30, func=game_end)
-text_screen(["Конец!"])
-pygame.quit()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Новогодняя игра')
+    parser.add_argument('--headless', action='store_true',
+                        help='no window and sound, simulation runs as fast as possible')
+    parser.add_argument('--script', help="input script, lines 'ticks keys' like '45 wf'")
+    parser.add_argument('--restarts', type=int, help='stop after this many lost games')
+    parser.add_argument('--seed', type=int, help='seed of the game random numbers')
+    parser.add_argument('--record', help='save input and seed of the session to this file')
+    parser.add_argument('--replay', help='play a recorded session back and show frame times')
+    parser.add_argument('--profile', help='write frame timings as JSON lines to this file, '
+                                          'F3 shows them on screen')
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    source = ScriptedInput.load(args.script) if args.script else KeyboardInput()
+    if args.replay:
+        seed, source = InputRecorder.load(args.replay)
+    if args.record:
+        source = InputRecorder(source, seed)
+    if args.profile:
+        profiler.open(args.profile)
+    try:
+        main(args.headless, source, args.restarts, seed)
+    finally:
+        profiler.close()
+        if args.record:
+            source.save(args.record)
+        if args.record or args.replay:
+            print('frame times, ms:', frame_stats.report())
+    pygame.quit()
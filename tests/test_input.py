@@ -0,0 +1,28 @@
+import pytest
+
+from main import InputRecorder, PressedKeys, ScriptedInput
+
+
+def test_input_recording_round_trip(tmp_path):
+    steps = [(3, 'wf'), (2, ''), (70000, 'd'), (1, 'as')]
+    recorder = InputRecorder(ScriptedInput(steps, repeat=False), seed=2 ** 40 + 7)
+    pressed = [recorder.pressed() for _ in range(70006)]
+    assert recorder.choose(3) == 3
+    assert recorder.choose(None) is None
+    recorder.save(tmp_path / 'session.bin')
+
+    seed, replay = InputRecorder.load(tmp_path / 'session.bin')
+    assert seed == 2 ** 40 + 7
+    assert [replay.pressed() for _ in range(70006)] == pressed
+    assert not replay.finished
+    assert replay.pressed() == PressedKeys()
+    assert replay.finished
+    assert (replay.choose(1), replay.choose(1), replay.choose(1)) == (3, None, 1)
+
+
+def test_input_recording_of_other_version(tmp_path):
+    data = bytearray(InputRecorder(ScriptedInput([]), seed=0).to_bytes())
+    data[4] += 1
+    (tmp_path / 'old.bin').write_bytes(bytes(data))
+    with pytest.raises(ValueError):
+        InputRecorder.load(tmp_path / 'old.bin')
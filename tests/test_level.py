@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from main import Level, compile_level, load_compiled_level
+
+LEVEL = ['KKKKKK',
+         'K@AA1K',
+         'K*A#-K',
+         'KKKKKK']
+
+
+def test_level_round_trip():
+    level = compile_level(LEVEL)
+    loaded = Level.from_buffer(level.to_bytes())
+    assert (loaded.width, loaded.height) == (level.width, level.height)
+    assert bytes(loaded.tiles) == bytes(level.tiles)
+    assert bytes(loaded.flags) == bytes(level.flags)
+    assert loaded.spawners == level.spawners == [(1, 2, 0), (4, 2, 1)]
+    assert loaded.entities == level.entities
+
+
+def test_level_rejects_other_data():
+    with pytest.raises(ValueError):
+        Level.from_buffer(b'NOPE' + compile_level(LEVEL).to_bytes()[4:])
+
+
+def test_cache_of_other_map_with_the_same_prefix_is_kept(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data/cache')
+    for name in ('map.txt', 'map-2.txt'):
+        with open(os.path.join('data', name), 'w') as mapFile:
+            mapFile.write('\n'.join(LEVEL) + '\n')
+    load_compiled_level('map-2.txt')
+    # старый кэш этой же карты
+    open('data/cache/map-0123456789abcdef.lvl', 'wb').close()
+    level = load_compiled_level('map.txt')
+    cached = os.listdir('data/cache')
+    assert len(cached) == 2
+    assert 'map-0123456789abcdef.lvl' not in cached
+    assert sum(name.startswith('map-2-') for name in cached) == 1
+    assert bytes(level.tiles) == bytes(compile_level(LEVEL).tiles)
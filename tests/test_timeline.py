@@ -0,0 +1,63 @@
+from main import Timeline
+
+
+def recorder(fired, name):
+    return lambda time: fired.append((name, time))
+
+
+def test_due_events_fire_in_time_then_registration_order():
+    timeline, fired = Timeline(), []
+    timeline.at(10, recorder(fired, 'a'))
+    timeline.at(5, recorder(fired, 'b'))
+    timeline.at(10, recorder(fired, 'c'))
+    timeline.update(4)
+    assert fired == []
+    # пропущенное время - события срабатывают на первом тике после него
+    timeline.update(12)
+    assert fired == [('b', 12), ('a', 12), ('c', 12)]
+    timeline.update(20)
+    assert len(fired) == 3
+
+
+def test_event_added_by_a_callback_fires_in_the_same_update_if_due():
+    timeline, fired = Timeline(), []
+    timeline.at(1, lambda time: timeline.at(time, recorder(fired, 'next')))
+    timeline.update(1)
+    assert fired == [('next', 1)]
+
+
+def test_trigger_fires_once():
+    timeline, fired = Timeline(), []
+    timeline.when(lambda time: time >= 3, recorder(fired, 'trigger'))
+    for time in range(6):
+        timeline.update(time)
+    assert fired == [('trigger', 3)]
+
+
+def test_drop_forgets_events_and_triggers_of_owner_only():
+    timeline, fired = Timeline(), []
+    owner, other = object(), object()
+    timeline.at(1, recorder(fired, 'owner event'), owner)
+    timeline.when(lambda time: True, recorder(fired, 'owner trigger'), owner)
+    timeline.at(2, recorder(fired, 'other event'), other)
+    timeline.drop(owner)
+    timeline.update(5)
+    assert fired == [('other event', 5)]
+
+
+def test_restore_after_drop_brings_events_back():
+    timeline, fired = Timeline(), []
+    owner = object()
+    timeline.at(2, recorder(fired, 'event'), owner)
+    timeline.when(lambda time: time > 1, recorder(fired, 'trigger'), owner)
+    state = timeline.state()
+    timeline.drop(owner)
+    timeline.update(3)
+    assert fired == []
+    timeline.restore(state)
+    timeline.update(3)
+    assert fired == [('trigger', 3), ('event', 3)]
+    # снимок не меняется от того, что после него сработало
+    timeline.restore(state)
+    timeline.update(4)
+    assert len(fired) == 4
@@ -0,0 +1,34 @@
+import pytest
+
+import main
+from main import WalkableCells
+
+
+@pytest.fixture
+def cells():
+    main.rng.seed(3)
+    walkable = WalkableCells()
+    walkable.cells = [(x, 0) for x in range(6)]
+    return walkable
+
+
+def test_sample_keeps_limits_when_possible(cells):
+    cells.cells = [(x, 0) for x in range(20)]
+    chosen = cells.sample(3, spacing=2)
+    assert len(set(chosen)) == 3
+    assert all(abs(x1 - x2) >= 2 for x1, _ in chosen for x2, _ in chosen if x1 != x2)
+
+
+def test_sample_relaxes_limits_to_find_count_cells(cells):
+    # 5 клеток через одну в ряду из 6 не поместить, и все клетки близко к away_from
+    chosen = cells.sample(5, spacing=2, away_from=(0, 0), distance=10 ** 4)
+    assert len(set(chosen)) == 5
+
+
+def test_sample_returns_all_cells_when_there_are_fewer(cells):
+    assert sorted(cells.sample(10, spacing=3)) == cells.cells
+
+
+def test_sample_without_cells():
+    with pytest.raises(ValueError):
+        WalkableCells().sample(1)